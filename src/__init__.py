@@ -9,4 +9,4 @@ __version_info__ = (1, 0, 1)
 __version__ = '.'.join(map(str, __version_info__))
 __author__ = "Dongsheng Mu"
 
-__all__ = ['interact', 'pyssh', 'util']
\ No newline at end of file
+__all__ = ['archive', 'cassette', 'interact', 'pyssh', 'shard', 'telnet', 'util']
\ No newline at end of file
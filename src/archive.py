@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# An indexed on-disk archive of the command outputs of InteractiveSubprocess sessions, in SQLite.
+# Copyright (c) 2014 Dongsheng Mu.
+# License: MIT (http://www.opensource.org/licenses/mit-license.php)
+
+
+import Queue
+import sqlite3
+import threading
+import util
+
+from collections import namedtuple
+
+
+# A command executed in a session, with its outputs.
+ArchiveRecord = namedtuple('ArchiveRecord', ['id', 'host', 'cmd', 'start', 'end', 'output', 'error'])
+
+
+class Archive(object):
+    """An append-only archive of the command outputs, in a SQLite database file, with a full text
+    index of the commands and the outputs by the SQLite FTS5 or FTS4 module if available.
+
+    The records are written by a background thread, in a transaction per batch, so adding a record
+    to the archive doesn't block the read loop of the sessions. A search waits for the records added
+    before it to be written. There is one archive per database file, shared by all its sessions.
+    """
+    __metaclass__ = util.SingletonPerParam
+
+    # max records written in a transaction
+    BATCH = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = Queue.Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+        db = self._open()
+        db.execute('CREATE TABLE IF NOT EXISTS commands (id INTEGER PRIMARY KEY, host TEXT, cmd TEXT, '
+                   'start REAL, end REAL, output TEXT, error TEXT)')
+        db.execute('CREATE INDEX IF NOT EXISTS commands_host ON commands (host, start)')
+        self.fts = None
+        for fts, columns in (('fts5', "cmd, output, error, content='commands', content_rowid='id'"),
+                             ('fts4', "content='commands', cmd, output, error")):
+            try:
+                db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS commands_%s USING %s(%s)' % (fts, fts, columns))
+            except sqlite3.OperationalError:
+                continue
+            self.fts = fts
+            break
+        db.commit()
+        db.close()
+
+    def _open(self):
+        db = sqlite3.connect(self.path, timeout=60)
+        db.text_factory = str
+        db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def add(self, host, cmd, start, end, output, error=''):
+        """Queue a command record to be written, without waiting for the write.
+
+        - host: the name of the session, e.g. the host name.
+        - cmd: the command.
+        - start, end: the timestamps of the command start and end.
+        - output, error: the stdout and stderr outputs of the command.
+        """
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, name='archive %s' % self.path)
+                self._writer.daemon = True
+                self._writer.start()
+                # the daemon writer is not waited at exit, write the queued records before exit.
+                util.exit_handler(self.close)
+        self._queue.put((host, cmd, start, end, output, error))
+
+    def _write(self):
+        db = self._open()
+        rowid = 'rowid' if self.fts == 'fts5' else 'docid'
+        while True:
+            records = [self._queue.get()]
+            while records[-1] is not None and len(records) < self.BATCH:
+                try:
+                    records.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = records[-1] is None
+            records = [tuple(x.decode('utf-8', 'replace') if isinstance(x, str) else x for x in r)
+                       for r in records if r is not None]
+            with db:
+                for r in records:
+                    i = db.execute('INSERT INTO commands (host, cmd, start, end, output, error) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)', r).lastrowid
+                    if self.fts:
+                        db.execute('INSERT INTO commands_%s (%s, cmd, output, error) VALUES (?, ?, ?, ?)'
+                                   % (self.fts, rowid), (i, r[1], r[4], r[5]))
+            for _ in xrange(len(records) + stop):
+                self._queue.task_done()
+            if stop:
+                break
+        db.close()
+
+    def flush(self):
+        """Wait till all the added records are written."""
+        self._queue.join()
+
+    def close(self):
+        """Write all the added records, and stop the writer thread. A later add() restarts it."""
+        with self._lock:
+            if self._writer is not None:
+                self._queue.put(None)
+                self._writer.join()
+                self._writer = None
+
+    def search(self, text=None, host=None, cmd=None, since=None, limit=100):
+        """Search the archived commands, return a list of ArchiveRecord, from the oldest.
+
+        - text: a full text query of the commands and outputs, in the FTS query syntax, e.g. 'error AND bgp'.
+            Without FTS, it is a substring of the stdout output.
+        - host: only the commands of the host.
+        - cmd: only the commands starting with it.
+        - since: only the commands started since the timestamp.
+        - limit: max records to return.
+        """
+        self.flush()
+        query = 'SELECT c.id, c.host, c.cmd, c.start, c.end, c.output, c.error FROM commands c'
+        where, args = [], []
+        if text and self.fts:
+            query += ' JOIN commands_%s f ON f.%s = c.id' % (self.fts, 'rowid' if self.fts == 'fts5' else 'docid')
+            where.append('commands_%s MATCH ?' % self.fts)
+            args.append(text)
+        elif text:
+            where.append('instr(c.output, ?) > 0')
+            args.append(text)
+        if host is not None:
+            where.append('c.host = ?')
+            args.append(host)
+        if cmd is not None:
+            where.append('substr(c.cmd, 1, ?) = ?')
+            args += [len(cmd), cmd]
+        if since is not None:
+            where.append('c.start >= ?')
+            args.append(since)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY c.id LIMIT ?'
+        args.append(limit)
+        db = self._open()
+        try:
+            return [ArchiveRecord(*x) for x in db.execute(query, args)]
+        finally:
+            db.close()
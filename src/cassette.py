@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# Record the inputs and outputs of an InteractiveSubprocess to a cassette file, and replay them as a fake process.
+# Copyright (c) 2014 Dongsheng Mu.
+# License: MIT (http://www.opensource.org/licenses/mit-license.php)
+
+
+import errno
+import gzip
+import json
+import os
+import select
+import threading
+import time
+
+
+# stream ids of the cassette events, and the exit of the process
+INPUT, STDOUT, STDERR, EXIT = 'i', 'o', 'e', 'x'
+
+
+def _open(filename, mode):
+    return gzip.open(filename, mode) if filename.endswith('.gz') else open(filename, mode)
+
+
+class Recorder(object):
+    """Record the inputs and the outputs of a process to a cassette file, gzipped if the file name ends with '.gz'.
+
+    A cassette is JSON lines. The first line is a header of {"cmdline": ..., "time": ...}, and each of the
+    following lines is an event of [time, stream, data], the time relative to the header time, the stream of
+    INPUT, STDOUT or STDERR, and the data of an input or output chunk, '' for the EOF of an output,
+    or the stream of EXIT and the exit code of the process.
+    The data is decoded by latin-1, so any byte survives the JSON.
+    """
+    INPUT, STDOUT, STDERR, EXIT = INPUT, STDOUT, STDERR, EXIT
+
+    def __init__(self, filename, cmdline=''):
+        self.filename = filename
+        self.start = time.time()
+        self._file = _open(filename, 'wb')
+        self._file.write(json.dumps({'cmdline': cmdline, 'time': self.start}) + '\n')
+
+    def write(self, stream, data):
+        if self._file is None:
+            return
+        self._file.write(json.dumps([round(time.time() - self.start, 3), stream, data.decode('latin-1')]) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def load(filename):
+    """Load a cassette file, return (header, events), events is a list of (time, stream, data)."""
+    with _open(filename, 'rb') as f:
+        header = json.loads(f.readline())
+        events = [(t, stream, data.encode('latin-1')) for t, stream, data in (json.loads(x) for x in f)]
+    return header, events
+
+
+class ReplayProcess(object):
+    """A fake process that replays a cassette, with the interface of subprocess.Popen that
+    InteractiveSubprocess uses, i.e. stdin, stdout, stderr file objects, poll(), terminate() and kill().
+
+    A feeder thread writes the recorded outputs to the stdout and stderr pipes. An output recorded after
+    an input is only written after the same number of input bytes is read from the stdin pipe, so the
+    replay follows the script as the recording did. An input that differs from the recorded one is
+    reported in the stderr output. At the end of the cassette, the process exits with the recorded
+    exit code, or stays alive till terminated if the recording had no exit.
+    """
+    def __init__(self, filename, timing=False):
+        """Start to replay a cassette.
+
+        - filename: the cassette file, recorded by Recorder.
+        - timing: if True, replay the outputs with the original time gaps, otherwise at full speed.
+        """
+        self.pid = None
+        self.returncode = None
+        self.header, self.events = load(filename)
+        self.timing = timing
+        self._stopped = False
+        self._stdin_r, w = os.pipe()
+        self.stdin = os.fdopen(w, 'w', 0)
+        r, self._stdout_w = os.pipe()
+        self.stdout = os.fdopen(r, 'r', 0)
+        r, self._stderr_w = os.pipe()
+        self.stderr = os.fdopen(r, 'r', 0)
+        self._feeder = threading.Thread(target=self._feed, name='replay %s' % filename)
+        self._feeder.daemon = True
+        self._feeder.start()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self._feeder.join()
+        return self.returncode
+
+    def terminate(self):
+        self._close(-15)
+
+    def kill(self):
+        self._close(-9)
+
+    def _close(self, returncode):
+        if self.returncode is None:
+            self.returncode = returncode
+        self._stopped = True
+
+    def _read_input(self, size):
+        """Read size bytes from the stdin pipe, return None if stopped or the stdin is closed."""
+        data = ''
+        while len(data) < size:
+            if self._stopped:
+                return None
+            if not select.select([self._stdin_r], [], [], 0.1)[0]:
+                continue
+            chunk = os.read(self._stdin_r, size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _write(self, fd, data):
+        while data:
+            data = data[os.write(fd, data):]
+
+    def _feed(self):
+        outputs = {STDOUT: self._stdout_w, STDERR: self._stderr_w}
+        exit_code = None
+        last_time, last_wall = 0, time.time()
+        try:
+            for t, stream, data in self.events:
+                if self._stopped:
+                    break
+                if stream == INPUT:
+                    got = self._read_input(len(data))
+                    if got is None:
+                        break
+                    if got != data:
+                        self._write(self._stderr_w, 'cassette: input %r differs from the recorded %r\n' % (got, data))
+                elif stream in outputs:
+                    if self.timing:
+                        time.sleep(max(0, (t - last_time) - (time.time() - last_wall)))
+                    if data:
+                        self._write(outputs[stream], data)
+                    else:
+                        # EOF
+                        os.close(outputs.pop(stream))
+                elif stream == EXIT:
+                    # the outputs read after the exit are still replayed, before the exit.
+                    exit_code = int(data)
+                last_time, last_wall = t, time.time()
+        except OSError as e:
+            # the reading side is closed
+            if e.errno != errno.EPIPE:
+                raise
+        # the end of the cassette, exit or wait till terminated.
+        if exit_code is not None:
+            self._close(exit_code)
+        while not self._stopped:
+            if self._read_input(1 << 16) is None:
+                break
+        for fd in outputs.values() + [self._stdin_r]:
+            os.close(fd)
+
+
+def spawn(session, filename, timing=False):
+    """Start a ReplayProcess for an InteractiveSubprocess, and set its stdin, stdout and stderr.
+    Return None if fail to load the cassette.
+    """
+    try:
+        p = ReplayProcess(filename, timing=timing)
+    except (IOError, ValueError) as e:
+        session.print_warn('Fail to load cassette %s, %s' % (filename, e))
+        return None
+    session.stdin, session.stdout, session.stderr = p.stdin, p.stdout, p.stderr
+    return p
@@ -4,12 +4,10 @@
 # License: MIT (http://www.opensource.org/licenses/mit-license.php)
 
 
-from curses import ascii
 import errno
 import os
 import pty
 import re
-import select
 import shlex
 import sys
 import subprocess
@@ -17,6 +15,12 @@ import time
 import types
 import util
 
+from collections import namedtuple
+
+
+# An output chunk read from the process, with its timestamp and stream id.
+OutputEvent = namedtuple('OutputEvent', ['time', 'stream', 'data'])
+
 
 #
 # subprocess, to interact with shell, process.
@@ -36,6 +40,36 @@ class InteractiveSubprocess(object):
     CTRL_C = '\x03'
     CTRL_D = '\x04'
     CTRL_SQUARE = '\x1d'
+    # command to gracefully exit the process, used by close_sessions()
+    exit_cmd = None
+    # stream id of output events
+    STDOUT = 'stdout'
+    STDERR = 'stderr'
+    # I/O multiplexer to wait on the process outputs, one of util.SelectorBase subclasses.
+    selector_class = util.DefaultSelector
+    # with a learned prompt, the prompt regex only searches the new output plus this many preceding chars.
+    PROMPT_LOOKBACK = 1024
+    # max seconds the cached liveness of a child process is used, before poll it again.
+    POLL_INTERVAL = 0.05
+    # with capture_head/capture_tail of send(), the output kept for the expect search besides the tail,
+    # and the note in place of the skipped output.
+    CAPTURE_WINDOW = 8192
+    CAPTURE_SKIPPED = '\n... %d bytes skipped ...\n'
+    # marker line of the result of a command run at the remote shell, e.g. by cmd_poll(remote=True).
+    RESULT_MARKER = '__INTERACT_RESULT__'
+    # marker lines around the compressed output of cmd_bulk(), and its base64 decoding chunk size.
+    BULK_MARKERS = ('__INTERACT_BULK_BEGIN__', '__INTERACT_BULK_END__')
+    BULK_CHUNK = 1 << 20
+    # raw size of a file block sent by put(), each block is acknowledged before sending the next.
+    PUT_BLOCK = 1 << 20
+    # max bytes of input written at a time to a pty, the size of its line buffer, and to a pipe or socket.
+    # A write to a full buffer is partial, the rest is written when the input is writable again.
+    INPUT_CHUNK = 4096
+    INPUT_CHUNK_NO_TTY = 1 << 16
+    # read-only commands of stable outputs, that the command cache may answer. Any other command is always
+    # executed, and clears the cache, as it may change the outputs of the others.
+    CMD_CACHE_ALLOW = ('^(hostname( -[sfdi])?|uname( -[a-z]+)?|whoami|id|pwd|arch|nproc|'
+                       'show (version|chassis hardware))\\s*$')
 
     def __init__(self, cmd, name='', prompt=None, timeout=5, delay=0.1, idleout=None,
                  use_pty_stdin=False, use_pty_stdout=False, use_shell=False,
@@ -48,7 +82,10 @@ class InteractiveSubprocess(object):
                  flush=False, scrollback=False,
                  retry=0, lazy=False,
                  disable_echo=False,
-                 auto_reconnect=False):
+                 auto_reconnect=False,
+                 event_log=False,
+                 cmd_cache=0, cmd_cache_ttl=60, cmd_cache_allow=None,
+                 adaptive_timing=False, record=None, replay=None, replay_timing=False, archive=None):
         """Open a programmably interactive process.
 
         Parameters:
@@ -80,6 +117,26 @@ class InteractiveSubprocess(object):
         - disable_echo: if True, disable the terminal echo for input characters,
                 so the output log can be cleaner for some application.
         - auto_reconnect: if True, attemp to reconnect if a connection is dropped
+        - event_log: if True, log every output chunk as OutputEvent(time, stream, data) in self.events,
+                in the order they are read, for later replay or a merged view of stdout and stderr.
+        - cmd_cache: if not 0, cache the outputs of this many recent commands of cmd(), so a repeated
+                read-only command of cmd_cache_allow, e.g. "hostname -s", returns without a round-trip.
+                The cache is cleared on reconnect, prompt change, or any command not of cmd_cache_allow.
+        - cmd_cache_ttl: seconds a cached output is valid, None for never expire.
+        - cmd_cache_allow: a regex of the commands to be cached. Default is CMD_CACHE_ALLOW.
+        - adaptive_timing: if True, learn the latency and the output idle gaps of the commands, per command shape,
+                see util.CommandTiming. When a call doesn't specify an idleout, the default idleout, if the session
+                has one, is replaced by the learned one of the command shape, so an idleout based call returns
+                as soon as safe. When a call doesn't specify a timeout, the default timeout is extended to the
+                learned one if that is longer, so a slow device doesn't time out spuriously.
+                It can also be a util.CommandTiming object, e.g. to share the statistics among sessions.
+        - record: a cassette file name, to record every input and output chunk of the process with timestamps,
+                see cassette.Recorder. It is gzipped if the name ends with '.gz'.
+        - replay: a cassette file name, to replay the recorded outputs as a fake process, see cassette.ReplayProcess,
+                instead of starting the cmd. The session must send the same inputs as it did in the recording.
+        - replay_timing: if True, replay with the original time gaps of the outputs, otherwise at full speed.
+        - archive: an archive.Archive, or its SQLite file name, to archive each command of send() with its outputs,
+                written in background. A hidden input, e.g. a password, is archived as ''.
 
         NOTE: it uses fcntl to have a non-blocking pipe file object for
         subprocess, so that stdout.read won't hang. This only works for UNIX.
@@ -111,10 +168,31 @@ class InteractiveSubprocess(object):
         self.print_error = print_error if print_error else no_print
         self.scrollback = scrollback
         self.scroll_buf = ''
+        self.events = [] if event_log else None
         self._disable_echo = disable_echo
         self._replace_ctrl_c = False
         self._auto_reconnect = auto_reconnect
         self._had_connect = False
+        # liveness of the process is cached, and only re-checked after an EOF, or after POLL_INTERVAL.
+        self._exit_code = None
+        self._poll_time = None
+        self._throttled = True
+        self._selector = None
+        self._prompt_literal = (None, None)  # (prompt regex, the exact prompt string it matched)
+        self._input_chunk = self.INPUT_CHUNK
+        self._cmd_cache = util.LRUCache(cmd_cache, cmd_cache_ttl) if cmd_cache else None
+        self._cmd_cache_allow = re.compile(cmd_cache_allow if cmd_cache_allow else self.CMD_CACHE_ALLOW)
+        self._replay = (replay, replay_timing) if replay else None
+        if isinstance(archive, basestring):
+            import archive as archive_module
+            archive = archive_module.Archive(archive)
+        self.archive = archive
+        self._recorder = None
+        if record:
+            import cassette
+            self._recorder = cassette.Recorder(record, cmd)
+        self.timing = (adaptive_timing if isinstance(adaptive_timing, util.CommandTiming)
+                       else util.CommandTiming() if adaptive_timing else None)
 
         if not lazy:
             self._connect()
@@ -130,37 +208,41 @@ class InteractiveSubprocess(object):
 
         # open the process, as a subprocess.Popen object.
         self.print_input('Starting interactive-process %s: %s\n' % (self.name, self.cmdline))
-        cmd_list = self.cmdline if self.use_shell else shlex.split(self.cmdline)
 
         for attempt in xrange(self._init_retry + 1):
-            if self.use_pty_stdin or self.use_pty_stdout:
-                # Use a PTY pseudo terminal, for program that does tcgetattr, or other cases.
-                # with util.SudoPrivilege():   #FIXME: openpty may get 'Out of devices' error w/o sudo
-                master, slave = pty.openpty()
-            p = subprocess.Popen(cmd_list, bufsize=0,
-                                 stdin=slave if self.use_pty_stdin else subprocess.PIPE,
-                                 stdout=slave if self.use_pty_stdout else subprocess.PIPE,
-                                 stderr=subprocess.PIPE, shell=self.use_shell,
-                                 universal_newlines=True)
-            self.stdin = os.fdopen(master, 'w', 0) if self.use_pty_stdin else p.stdin
-            self.stdout = os.fdopen(master, 'rU', 0) if self.use_pty_stdout else p.stdout
-            self.stderr = p.stderr
+            p = self._spawn()
+            self.process = p
             if not p:
                 self.print_warn('fail to open %s process, "%s".' % (self.name, self.cmdline))
-
-            # change the pipe to non-blocking
-            util.tty_nonblocking(self.stdout)
-            util.tty_nonblocking(self.stderr)
-            # disable echo for cleaner output
-            if self._disable_echo:
-                util.term_set_echo(self.stdin.fileno(), enable=False)
-
-            self.process = p
-
-            self.peek()
-            if self.is_alive():
-                # connected
-                break
+            else:
+                self._exit_code = self._poll_time = None
+                if self._cmd_cache is not None:
+                    self._cmd_cache.clear()
+                # only a child process poll is a waitpid() syscall, other backends are always polled.
+                self._throttled = isinstance(p, subprocess.Popen)
+                # register the outputs once, to be waited by all later executions.
+                if self._selector is not None:
+                    self._selector.close()
+                self._selector = self.selector_class()
+                self._selector.register(self.stdout)
+                self._selector.register(self.stderr)
+
+                # change the pipe to non-blocking
+                util.tty_nonblocking(self.stdout)
+                util.tty_nonblocking(self.stderr)
+                if isinstance(self.stdin, file):
+                    util.tty_nonblocking(self.stdin)
+                self._input_chunk = (self.INPUT_CHUNK if os.isatty(self.stdin.fileno())
+                                     else self.INPUT_CHUNK_NO_TTY)
+                # disable echo for cleaner output
+                if self._disable_echo and os.isatty(self.stdin.fileno()):
+                    util.term_set_echo(self.stdin.fileno(), enable=False)
+
+                # the output available right after start is startup output, not a leftover to be skipped.
+                self.peek(continuous_output=True)
+                if self.is_alive():
+                    # connected
+                    break
             util.print_progress('Will retry "%s" in 1 sec, %s attempt ...' %
                                 (self.cmdline, attempt + 1), color=['cyan'])
             time.sleep(1)
@@ -178,6 +260,31 @@ class InteractiveSubprocess(object):
         self._had_connect = True
         return self.process
 
+    def _spawn(self):
+        """Start the process, set its self.stdin, self.stdout and self.stderr, and return the process.
+
+        A child class can override it for a different backend, which returns an object with the
+        subprocess.Popen methods of poll(), terminate() and kill(), and sets the file objects with
+        fileno() for the non-blocking read and write. Return None if fail to start.
+        """
+        if self._replay:
+            import cassette
+            return cassette.spawn(self, *self._replay)
+        cmd_list = self.cmdline if self.use_shell else shlex.split(self.cmdline)
+        if self.use_pty_stdin or self.use_pty_stdout:
+            # Use a PTY pseudo terminal, for program that does tcgetattr, or other cases.
+            # with util.SudoPrivilege():   #FIXME: openpty may get 'Out of devices' error w/o sudo
+            master, slave = pty.openpty()
+        p = subprocess.Popen(cmd_list, bufsize=0,
+                             stdin=slave if self.use_pty_stdin else subprocess.PIPE,
+                             stdout=slave if self.use_pty_stdout else subprocess.PIPE,
+                             stderr=subprocess.PIPE, shell=self.use_shell,
+                             universal_newlines=True)
+        self.stdin = os.fdopen(master, 'w', 0) if self.use_pty_stdin else p.stdin
+        self.stdout = os.fdopen(master, 'rU', 0) if self.use_pty_stdout else p.stdout
+        self.stderr = p.stderr
+        return p
+
     def _reconnect(self):
         """Reconnect if connected before and now the connection is dropped.
         Useful to start from fresh after a failed loop of test.
@@ -239,10 +346,19 @@ class InteractiveSubprocess(object):
             return o, e
 
     def is_alive(self, warn=False):
-        """Return True if the subprocess is alive."""
+        """Return True if the subprocess is alive.
+        The process is only polled after an EOF of its output, or POLL_INTERVAL since the last poll.
+        """
         if self.process is None:
             return False
-        stat = self.process.poll()
+        if self._exit_code is None:
+            now = time.time()
+            if self._poll_time is None or now - self._poll_time >= self.POLL_INTERVAL or not self._throttled:
+                self._poll_time = now
+                self._exit_code = self.process.poll()
+                if self._exit_code is not None and self._recorder is not None:
+                    self._recorder.write(self._recorder.EXIT, str(self._exit_code))
+        stat = self._exit_code
         if stat is not None and warn:
             self.print_warn('Process %s has exited with code %s' % (self.name, stat))
         return stat is None
@@ -252,6 +368,91 @@ class InteractiveSubprocess(object):
 
     def change_prompt(self, prompt):
         self.prompt = prompt
+        self._prompt_literal = (None, None)
+
+    @property
+    def prompt_literal(self):
+        """The exact prompt string matched by the prompt regex, or None if not learned yet."""
+        prompt, literal = self._prompt_literal
+        return literal if prompt == self.prompt else None
+
+    @prompt_literal.setter
+    def prompt_literal(self, literal):
+        self._prompt_literal = (self.prompt, literal)
+
+    def _find_expect(self, expect, text, start=0):
+        """Search the expect regex in the text, return the end position of the match, or None.
+
+        The prompt is stable within a directory or context, so for the prompt, the exact string
+        matched by the regex is learned, and later searched as a literal string first. If the
+        literal is not found, fall back to the regex, which only searches from the start position
+        (the already searched text length) minus PROMPT_LOOKBACK.
+        """
+        if expect != self.prompt:
+            m = re.search(expect, text)
+            return m.end() if m else None
+        prompt, literal = self._prompt_literal
+        if prompt == expect:
+            i = text.find(literal, max(0, start - len(literal) + 1))
+            if i >= 0:
+                return i + len(literal)
+        else:
+            start = 0
+        m = re.compile(expect).search(text, max(0, start - self.PROMPT_LOOKBACK))
+        if not m:
+            return None
+        if m.group():
+            # the prompt may has changed, e.g. by changing the working directory
+            self._prompt_literal = (expect, m.group())
+        return m.end()
+
+    def _read_stream(self, stream):
+        """Read the available output of the STDOUT or STDERR stream, and log it as an OutputEvent
+        if event_log is enabled. Return '' at EOF.
+        """
+        f = self.stdout if stream == self.STDOUT else self.stderr
+        try:
+            data = f.read()
+        except IOError as e:
+            if e.errno == errno.EAGAIN:
+                return ''
+            data = ''  # EIO of a closed pty
+        if not data:
+            # EOF, the process may have exited. Stop waiting on it, as an EOF is always ready.
+            self._poll_time = None
+            self._selector.unregister(f)
+        elif self.events is not None:
+            self.events.append(OutputEvent(time.time(), stream, data))
+        if self._recorder is not None:
+            self._recorder.write(self._recorder.STDOUT if stream == self.STDOUT else self._recorder.STDERR, data)
+        return data
+
+    def merged_output(self, since=0):
+        """Return the stdout and stderr outputs merged in the order they were read.
+        Requires event_log enabled.
+
+        - since: a timestamp, only merge the outputs read since then.
+        """
+        return ''.join(x.data for x in self.events if x.time >= since)
+
+    def replay(self, since=0, timing=False, print_output=None, print_stderr=None):
+        """Print the logged outputs again in the order they were read. Requires event_log enabled.
+
+        - since: a timestamp, only replay the outputs read since then.
+        - timing: if True, replay with the original time gaps between outputs.
+        - print_output, print_stderr: methods to print stdout and stderr outputs, default to the
+                process's print_output and print_stderr.
+        """
+        printers = {self.STDOUT: print_output or self.print_output,
+                    self.STDERR: print_stderr or self.print_stderr}
+        last = None
+        for x in self.events:
+            if x.time < since:
+                continue
+            if timing and last is not None:
+                time.sleep(x.time - last)
+            last = x.time
+            printers[x.stream](x.data)
 
     def _measure_idle(self, idle_start):
         old_start = idle_start
@@ -260,11 +461,31 @@ class InteractiveSubprocess(object):
             self._idle_gaps.append(idle_start - old_start)
         return idle_start
 
+    def _capture(self, text, captured, head, tail, slack=0, final=False):
+        """Move the first head bytes of the output text to captured[0], and drop the text before the
+        last tail bytes, counting the dropped bytes in captured[1]. To copy less, it only does so when
+        the text is longer than them plus slack.
+        Return the remaining text, or the captured output if final.
+        """
+        n = max(0, head - len(captured[0]))
+        if not final and len(text) <= n + tail + slack:
+            return text
+        captured[0] += text[:n]
+        text = text[n:]
+        drop = len(text) - tail
+        if drop > 0:
+            captured[1] += drop
+            text = text[drop:]
+        if final:
+            return captured[0] + (self.CAPTURE_SKIPPED % captured[1] if captured[1] else '') + text
+        return text
+
     @util.return_o_e
     def send(self, inputkeys, expect='', delay=None, timeout=None, idleout=None,
              new_prompt=None, hide_input=False, hide_output=False,
              continuous_output=False, ignore_no_output=False, end_with_newline=False,
-             peek=False, intercept_stdin=None):
+             peek=False, intercept_stdin=None, capture_head=None, capture_tail=None, stop=None, adaptive=True,
+             on_output=None):
         """Execute a cmd in the process, or send some input to the process.
 
         - inputkeys: key stokes to send to the process. Need to include '\\n' for
@@ -292,6 +513,18 @@ class InteractiveSubprocess(object):
         - intercept_stdin: a input terminal fd be intercepted and piped to the
                 subprocess. This allows user to response to a program that prompt for user input
                 (such like 'svn update' abnorm case handling).
+        - capture_head, capture_tail: if either is specified, only keep the first capture_head bytes and
+                the last capture_tail bytes of each of the outputs, with a CAPTURE_SKIPPED note of the bytes
+                skipped in between, so the memory is bounded for a huge output. The expect is searched in
+                the new output plus CAPTURE_WINDOW bytes before it. The skipped output is still printed,
+                and logged in the events if event_log is enabled.
+        - stop: a regex, once it is found in the stdout output, the rest of the output is not needed, so
+                interrupt the command by a Ctrl-C, and continue to wait for the expect, e.g. the prompt.
+                Any input not sent yet is dropped.
+        - adaptive: if False, don't use or learn the adaptive timing of the session for this call,
+                e.g. for a generated helper command, whose latency doesn't tell the others of its shape.
+        - on_output: a function called with each chunk of the stdout output as it is read, e.g. to consume a
+                huge output as it arrives, with capture_head/capture_tail to bound the returned output.
         - return: a tuple of (o, e), the process's stdout and stderr outputs.
         """
 
@@ -299,11 +532,13 @@ class InteractiveSubprocess(object):
             err = 'Connection "%s" not alive.' % self.name
             util.print_error(err)
             return '', 'ERROR: ' + err
-        p = self.process
+        shape = self.timing.shape(inputkeys) if self.timing is not None and adaptive else None
         if timeout is None:
-            timeout = self.timeout
+            # a learned timeout only extends the default, for a slow device. Commands of a shape may still
+            # differ in run time by their arguments, a shorter deadline may fail a legitimate run.
+            timeout = max(self.timeout, (self.timing.timeout(shape) if shape else None) or 0)
         if idleout is None:
-            idleout = self.idleout
+            idleout = self.idleout and ((self.timing.idleout(shape) if shape else None) or self.idleout)
         delay = delay if delay else self.delay
         delay = min(timeout, delay)
         if new_prompt:
@@ -315,11 +550,12 @@ class InteractiveSubprocess(object):
 
         start_time = time.time()
         idle_start = None
+        found = False
         # flush out any previous leftover output in the stdout/stderr internal buffer
-        if p.poll() is None:
-            has_oe = select.select([self.stdout, self.stderr], [], [], 0)[0]
+        if self.is_alive():
+            has_oe = self._selector.select(0)
             if self.stdout in has_oe:
-                self._remaining_output += self.stdout.read()
+                self._remaining_output += self._read_stream(self.STDOUT)
                 if not continuous_output:
                     print_output('previous remaining stdout output: "%s"' %
                                  self._remaining_output)
@@ -328,7 +564,7 @@ class InteractiveSubprocess(object):
                 if continuous_output and idleout:
                     idle_start = time.time()
             if self.stderr in has_oe:
-                self._remaining_err_output += self.stderr.read()
+                self._remaining_err_output += self._read_stream(self.STDERR)
                 if not continuous_output:
                     print_stderr('previous remaining stderr output: "%s"' %
                                  self._remaining_err_output)
@@ -337,16 +573,18 @@ class InteractiveSubprocess(object):
                 if continuous_output and idleout:
                     idle_start = time.time()
 
-        # send input to process
+        # send input to process. It is written in chunks when the input is writable, interleaved with
+        # reading the outputs, so a large input won't deadlock with a process blocked on its output.
+        pending = inputkeys
         if inputkeys:
             if not hide_input:
                 self.print_input(inputkeys)
-            self.stdin.write(inputkeys)
-            self.stdin.flush()
         intercept_buf = ''
 
         if timeout == self.NO_WAIT:
             # return without wait for any output. This is not a common use case.
+            if pending and self._flush_input(pending):
+                self.print_warn('%s has input not sent for "%s".' % (self.name, inputkeys[:80].__repr__()))
             self.print_warn('timeout==NO_WAIT, returned without waiting for any output. '
                             'The output from "%s" may defer to next execution.' % inputkeys.__repr__())
             return '', ''
@@ -372,35 +610,44 @@ class InteractiveSubprocess(object):
                 previous_err_output = self._remaining_err_output
             self._remaining_err_output = ''
 
-        if p.poll() is not None:
+        if not self.is_alive():
             # program exited
-            has_oe = select.select([self.stdout, self.stderr], [], [], 0)[0]
+            has_oe = self._selector.select(0)
             if self.stdout in has_oe:
-                o = self.stdout.read()
+                o = self._read_stream(self.STDOUT)
                 output += o
                 print_output(o)
+                if on_output and o:
+                    on_output(o)
             if self.stderr in has_oe:
-                eo = self.stderr.read()
+                eo = self._read_stream(self.STDERR)
                 err_output += eo
                 print_stderr(eo)
             if not hide_output:
-                self.print_warn('Process %s has exited with code %s' % (self.name, p.poll()))
+                self.print_warn('Process %s has exited with code %s' % (self.name, self._exit_code))
 
-        select_terminals = [self.stdout, self.stderr]
         if intercept_stdin:
-            select_terminals.append(intercept_stdin)
-        while p.poll() is None:  # check whether the process exits.
-            # wait on terminal IO
-            try:
-                has_ioe = select.select(select_terminals, [], [], delay)[0]
-            except select.error as (code, msg):
-                if code == errno.EINTR:
-                    # with error: (4, 'Interrupted system call'). This EINTR exception is normal
-                    self.print_warn('Ignored: %s, %s' % (code, msg))
-                    has_ioe = []
-                else:
-                    self.print_error('Error: %s, %s' % (code, msg))
-                    raise
+            self._selector.register(intercept_stdin)
+        if pending and self.is_alive():
+            self._watch_input(True)
+        searched_out = searched_err = 0  # length of the output already searched for expect
+        stop = re.compile(stop) if stop else None
+        stop_buf = ''   # the recent stdout output to search the stop, after the echo of the input line
+        stop_echo = inputkeys.strip().splitlines()[-1] if stop and inputkeys and inputkeys.strip() else ''
+        capture = capture_head is not None or capture_tail is not None
+        if capture:
+            capture_head, capture_tail = capture_head or 0, capture_tail or 0
+            keep = max(capture_tail, self.CAPTURE_WINDOW)
+            captured_out, captured_err = ['', 0], ['', 0]   # [head, skipped bytes]
+        while self.is_alive():  # check whether the process exits.
+            # wait on terminal IO. No wait if there is output to be searched, e.g. the peeked output.
+            has_ioe = self._selector.select(delay if (searched_out, searched_err) == (len(output), len(err_output))
+                                            else 0)
+
+            if pending and self._input_ready(has_ioe):
+                pending = pending[self._write_some(pending):]
+                if not pending:
+                    self._watch_input(False)
 
             if intercept_stdin and intercept_stdin in has_ioe:
                 i = intercept_stdin.read()
@@ -411,51 +658,77 @@ class InteractiveSubprocess(object):
                         continue
                 if i == self.CTRL_SQUARE:
                     # Ctrl-] escape key pressed
+                    self._selector.unregister(intercept_stdin)
+                    if pending:
+                        self._watch_input(False)
                     return output, err_output, intercept_buf
                 intercept_buf += i
-                self.stdin.write(i)
-                self.stdin.flush()
+                self._write_input(i)
                 if self._disable_echo:
                     # FIXME, once turn back on ECHO for console(),
                     # could not get the echo to treat '\r' as CRLF,
                     # thus doing software echo for now.
+                    from curses import ascii
                     if ascii.isprint(i):
                         self.print_input(i)
                     elif i == '\r':
                         self.print_input('\n')
             if self.stderr in has_ioe:
                 # now, check the stderr output
-                try:
-                    eo = self.stderr.read()
+                eo = self._read_stream(self.STDERR)
+                if eo:
                     print_stderr(eo)
                     err_output += eo
                     if idleout:
                         idle_start = self._measure_idle(idle_start)
-                except IOError:
-                    pass
-            if self.stdout in has_ioe:
-                try:
-                    o = self.stdout.read()
+            if has_ioe.get(self.stdout, 0) & util.EVENT_READ:
+                o = self._read_stream(self.STDOUT)
+                if o:
                     print_output(o)
                     output += o
+                    if on_output:
+                        on_output(o)
+                    if stop:
+                        stop_buf += o
                     if idleout:
                         idle_start = self._measure_idle(idle_start)
-                except IOError:
-                    pass
 
             if expect:
                 # check stdout output
-                m = re.search(expect, output)
-                if m:
-                    self._remaining_output = output[m.end():]
-                    output = output[: m.end()]
+                end = self._find_expect(expect, output, searched_out)
+                if end is not None:
+                    self._remaining_output = output[end:]
+                    output = output[: end]
+                    found = True
                     break
                 # check stderr err_output
-                m = re.search(expect, err_output)
-                if m:
-                    self._remaining_err_output = err_output[m.end():]
-                    err_output = err_output[: m.end()]
+                end = self._find_expect(expect, err_output, searched_err)
+                if end is not None:
+                    self._remaining_err_output = err_output[end:]
+                    err_output = err_output[: end]
+                    found = True
                     break
+            if stop_echo and ('\n' in stop_buf or len(stop_buf) > len(stop_echo) + self.PROMPT_LOOKBACK):
+                # skip the echo of the input, so the stop is not found in the command itself.
+                line, newline, rest = stop_buf.partition('\n')
+                if newline and line.rstrip('\r').endswith(stop_echo):
+                    stop_buf = rest
+                stop_echo = ''
+            if stop and not stop_echo and stop_buf:
+                if stop.search(stop_buf):
+                    if pending:
+                        self._watch_input(False)
+                        pending = ''
+                    if not hide_input:
+                        self.print_input('Send Ctrl-C SIGINT to %s, as "%s" is found.\n' % (self.name, stop.pattern))
+                    self._write_input(self.CTRL_C)
+                    stop = None
+                else:
+                    stop_buf = stop_buf[-self.PROMPT_LOOKBACK:]
+            if capture:
+                output = self._capture(output, captured_out, capture_head, keep, self.CAPTURE_WINDOW)
+                err_output = self._capture(err_output, captured_err, capture_head, keep, self.CAPTURE_WINDOW)
+            searched_out, searched_err = len(output), len(err_output)
             if (timeout != self.FOREVER) and time.time() - start_time >= timeout:
                 if (timeout != self.FOREVER) and expect:
                     self.print_warn('%s timed out for "%s", timeout %0.3f seconds, '
@@ -473,10 +746,25 @@ class InteractiveSubprocess(object):
                                          expect))
                     break
         # end while loop
-
+        if intercept_stdin:
+            self._selector.unregister(intercept_stdin)
+        if pending and self.is_alive():
+            # returned before all the input is written, e.g. expect found in the output of the first line.
+            self._watch_input(False)
+            pending = self._flush_input(pending)
+        if pending:
+            self.print_warn('%s has %d bytes of input not sent for "%s".'
+                            % (self.name, len(pending), inputkeys[:80].__repr__()))
+
+        if shape:
+            self.timing.record(shape, latency=time.time() - start_time if found else None,
+                               idle_gap=max(self._idle_gaps[1:]) if idleout and len(self._idle_gaps) > 1 else None)
         if idleout:
             self.max_idle_gap = max(self._idle_gaps)
             self._idle_gaps = [self.max_idle_gap]   # so it won't accumulate over time
+        if capture:
+            output = self._capture(output, captured_out, capture_head, capture_tail, final=True)
+            err_output = self._capture(err_output, captured_err, capture_head, capture_tail, final=True)
         if expect and (not output) and (not ignore_no_output):
             self.print_warn('%s has no output for "%s", expecting "%s".'
                             % (self.name, inputkeys.__repr__(), expect))
@@ -488,6 +776,9 @@ class InteractiveSubprocess(object):
             # previous leftover output is always stored in the scroll buff
             self.scroll_buf += previous_output + output
             self.scroll_buf += previous_err_output + err_output
+        if self.archive is not None and inputkeys:
+            self.archive.add(self.name, '' if hide_input else inputkeys.strip(), start_time, time.time(),
+                             output, err_output)
 
         if (not output.endswith('\n')) and end_with_newline:
             # normal cmd prompt doesn't start a newline, it is hard to read when other print
@@ -496,7 +787,7 @@ class InteractiveSubprocess(object):
 
         return output, err_output
 
-    def cmd(self, cmd=None, timeout=None, new_prompt=None, *args, **kwargs):
+    def cmd(self, cmd=None, timeout=None, new_prompt=None, cache=None, *args, **kwargs):
         """Execute a command.
         Compare to send(), cmd() will make sure the input ends with a single `\\n`
         to avoid multiple prompts, and make sure the cursor ends at the begining
@@ -510,11 +801,43 @@ class InteractiveSubprocess(object):
             If it is NO_WAIT, return immediately without waiting for any output. This is not common, suggest use 0.01s.
         - new_prompt: If not None, change the default prompt. Some command execution will affect
             the default prompt, such like changing shell or changing the working dir in a server connection.
+        - cache: whether to use the command cache of the session, see cmd_cache of __init__().
+            If None, only a command of cmd_cache_allow is cached. If True, the caller tells the command
+            is read-only, to be cached. If False, don't use the cache.
         """
         if cmd is not None:
             cmd = cmd.strip() + '\n'
-        return self.send(inputkeys=cmd, timeout=timeout, new_prompt=new_prompt,
-                         end_with_newline=True, *args, **kwargs)
+        if self._cmd_cache is None or cmd is None:
+            return self.send(inputkeys=cmd, timeout=timeout, new_prompt=new_prompt,
+                             end_with_newline=True, *args, **kwargs)
+
+        expect = kwargs.get('expect', '')
+        key = (cmd, expect)
+        allowed = bool(self._cmd_cache_allow.search(cmd))
+        if new_prompt or not (allowed or cache):
+            # the command may change the outputs of the others
+            self._cmd_cache.clear()
+            cache = False
+        elif cache is None:
+            cache = True
+        if cache and (expect is None or kwargs.get('continuous_output') or kwargs.get('peek')
+                        or kwargs.get('stop')):
+            cache = False
+        oe = self._cmd_cache.get(key) if cache else None
+        if oe is not None:
+            if not kwargs.get('hide_input'):
+                self.print_input(cmd)
+            if not kwargs.get('hide_output'):
+                self.print_output(oe[0])
+                self.print_stderr(oe[1])
+            return util.Namedtuple_oe(*oe)
+        oe = self.send(inputkeys=cmd, timeout=timeout, new_prompt=new_prompt,
+                       end_with_newline=True, *args, **kwargs)
+        # only cache a complete output, that ends with the expected output.
+        expect = expect if expect else self.prompt
+        if cache and any(self._find_expect(expect, x) is not None for x in oe):
+            self._cmd_cache.set(key, tuple(oe))
+        return oe
 
     def cmd_hide(self, cmd=None, hide_input=True, hide_output=True, *args, **kwargs):
         """Hide the input/output, but not errors. Useful for backend task of no user interest.
@@ -525,8 +848,212 @@ class InteractiveSubprocess(object):
         """
         return self.cmd(cmd=cmd, hide_input=hide_input, hide_output=hide_output, *args, **kwargs)
 
+    def cmd_bulk(self, cmd, to_file=None, level=6, **kwargs):
+        """Execute a command of very large output, e.g. dumping a log.
+        The output is compressed by gzip and encoded by base64 at the remote side, so much less
+        data goes through the terminal, then it is decoded and decompressed locally as it arrives,
+        so only up to BULK_CHUNK of the encoded output is kept in memory, besides the decoded output
+        if it is returned.
+
+        - cmd: command to be executed. Its stderr output is merged into the output.
+        - to_file: if specified, write the output to this file, instead of returning it.
+        - level: gzip compression level, 1 (fastest) to 9 (best).
+        - \*\*kwargs: optional parameters for self.cmd_hide(), e.g. a long timeout.
+
+        - return: the command output as is, i.e. without terminal echo or CRLF line ends,
+          or to_file if it is specified. None if the transfer fails.
+        """
+        import base64
+        import zlib
+        begin, end = self.BULK_MARKERS
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip format
+        out = open(to_file, 'wb') if to_file else []
+        write = out.write if to_file else out.append
+        # the partial last line, the base64 lines not decoded yet and their size, the stage of
+        # 'begin' (before the begin marker), 'data' or 'end', and the decoding error if any.
+        state = dict(line='', data=[], size=0, stage='begin', error=None)
+
+        def decode(final=False):
+            data = ''.join(state['data'])
+            n = len(data) if final else len(data) // 4 * 4
+            state['data'], state['size'] = [data[n:]], len(data) - n
+            write(decompressor.decompress(base64.b64decode(data[:n])))
+
+        def on_output(text):
+            if state['stage'] == 'end' or state['error']:
+                return
+            lines = (state['line'] + text).split('\n')
+            state['line'] = lines.pop()
+            try:
+                for x in lines:
+                    x = x.strip()
+                    if state['stage'] == 'begin':
+                        if x == begin:
+                            state['stage'] = 'data'
+                    elif x == end:
+                        decode(final=True)
+                        write(decompressor.flush())
+                        state['stage'] = 'end'
+                        return
+                    else:
+                        state['data'].append(x)
+                        state['size'] += len(x)
+                if state['size'] >= self.BULK_CHUNK:
+                    decode()
+            except (TypeError, zlib.error) as err:
+                state['error'] = err
+
+        # the decoded output is not kept in the returned output.
+        kwargs.setdefault('capture_tail', self.CAPTURE_WINDOW)
+        try:
+            self.cmd_hide(util.bulk_capture_cmd(cmd, begin, end, level), adaptive=False, on_output=on_output,
+                          **kwargs)
+        finally:
+            if to_file:
+                out.close()
+        if state['error']:
+            self.print_error('%s bulk output of "%s" is corrupted, %s' % (self.name, cmd, state['error']))
+            return None
+        if state['stage'] != 'end':
+            self.print_error('%s bulk output of "%s" is incomplete' % (self.name, cmd))
+            return None
+        return to_file if to_file else ''.join(out)
+
+    def _watch_input(self, enable):
+        """Start or stop waiting on the process input to be writable, along with its outputs."""
+        if self.stdin.fileno() == self.stdout.fileno():
+            # a pty is both the input and output
+            if self.stdout in self._selector:
+                self._selector.modify(self.stdout, util.EVENT_READ | (util.EVENT_WRITE if enable else 0))
+        elif enable:
+            self._selector.register(self.stdin, util.EVENT_WRITE)
+        else:
+            self._selector.unregister(self.stdin)
+
+    def _input_ready(self, has_ioe):
+        shared = self.stdin.fileno() == self.stdout.fileno()
+        return bool(has_ioe.get(self.stdout if shared else self.stdin, 0) & util.EVENT_WRITE)
+
+    def _write_some(self, data):
+        """Write a chunk of data to the process input, without blocking.
+        Return the number of bytes written, 0 if the input buffer is full.
+        """
+        if not isinstance(self.stdin, file):
+            # e.g. a telnet.TelnetWriter, which sends all the data
+            self.stdin.write(data[:self._input_chunk])
+            n = min(len(data), self._input_chunk)
+        else:
+            try:
+                n = os.write(self.stdin.fileno(), data[:self._input_chunk])
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                return 0
+        if self._recorder is not None and n:
+            self._recorder.write(self._recorder.INPUT, data[:n])
+        return n
+
+    def _flush_input(self, data):
+        """Write the rest of the input of an execution that has returned, in the session timeout.
+        The outputs meanwhile are kept as the remaining output for the next execution.
+        Return the input not written.
+        """
+        self._watch_input(True)
+        deadline = time.time() + self.timeout
+        while data and self.is_alive() and time.time() < deadline:
+            has_ioe = self._selector.select(self.delay)
+            if self._input_ready(has_ioe):
+                data = data[self._write_some(data):]
+            if has_ioe.get(self.stdout, 0) & util.EVENT_READ:
+                self._remaining_output += self._read_stream(self.STDOUT)
+            if self.stderr in has_ioe:
+                self._remaining_err_output += self._read_stream(self.STDERR)
+        if self.is_alive():
+            self._watch_input(False)
+        return data
+
+    def _write_input(self, data):
+        """Write all the data to the process input, wait for it to be writable if its buffer is full.
+        It doesn't read the outputs meanwhile, only for short input.
+        """
+        waiter = None
+        while data:
+            n = self._write_some(data)
+            data = data[n:]
+            if data and not n:
+                if waiter is None:
+                    waiter = util.DefaultSelector()
+                    waiter.register(self.stdin, util.EVENT_WRITE)
+                waiter.select()
+
+    def _remote_md5(self, path):
+        o, e = self.cmd_hide(util.md5sum_cmd(path), adaptive=False)
+        return util.get_field('(?m)^([0-9a-f]{32})\\b', o)
+
+    def put(self, local_path, remote_path, compress=True, timeout=None):
+        """Upload a local file to the remote side over the session, without another connection.
+
+        The file is sent in blocks of PUT_BLOCK bytes, each as base64 lines (of gzip data if compress)
+        to "base64 -d" at the remote side with the terminal echo off, and ended by a Ctrl-D.
+        The shell prompt after a block acknowledges it before the next block is sent.
+        At last the md5 checksums of both sides are compared.
+
+        - timeout: timeout in seconds for each block. Default is the session timeout.
+        - return: True if the file is uploaded, otherwise False.
+        """
+        import base64
+        import zlib
+        ready = '%s ready\r?\n' % self.RESULT_MARKER
+        with open(local_path, 'rb') as f:
+            append = False
+            while True:
+                block = f.read(self.PUT_BLOCK)
+                if append and not block:
+                    break
+                if compress:
+                    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip format
+                    block = compressor.compress(block) + compressor.flush()
+                o, e = self.cmd_hide(util.upload_block_cmd(remote_path, append, compress, self.RESULT_MARKER),
+                                     expect='%s|%s' % (ready, self.prompt), timeout=timeout, adaptive=False)
+                if not re.search(ready, o):
+                    self.print_error('%s fail to start upload of "%s", %s' % (self.name, remote_path, e))
+                    return False
+                o, e = self.send(base64.encodestring(block) + self.CTRL_D, hide_input=True, hide_output=True,
+                                 timeout=timeout, ignore_no_output=True)
+                if '%s fail' % self.RESULT_MARKER in o:
+                    self.print_error('%s fail to upload "%s", %s' % (self.name, remote_path, o + e))
+                    return False
+                append = True
+        if self._remote_md5(remote_path) != util.md5_file(local_path):
+            self.print_error('%s checksum mismatch of uploaded "%s"' % (self.name, remote_path))
+            return False
+        return True
+
+    def get(self, remote_path, local_path=None, timeout=None):
+        """Download a remote file over the session, without another connection.
+
+        The file is transferred as gzip compressed base64 text by cmd_bulk(), and its md5 checksums
+        of both sides are compared.
+
+        - local_path: default is the file name of remote_path in the current directory.
+        - timeout: timeout in seconds for the transfer. Default is the session timeout.
+        - return: True if the file is downloaded, otherwise False.
+        """
+        local_path = local_path if local_path else os.path.basename(remote_path)
+        md5 = self._remote_md5(remote_path)
+        if md5 is None:
+            self.print_error('%s fail to get the checksum of "%s"' % (self.name, remote_path))
+            return False
+        if self.cmd_bulk('cat -- %s' % util.shell_quote(remote_path), to_file=local_path, timeout=timeout) is None:
+            return False
+        if util.md5_file(local_path) != md5:
+            self.print_error('%s checksum mismatch of downloaded "%s"' % (self.name, remote_path))
+            return False
+        return True
+
     @util.return_o_e_r
-    def cmd_search(self, cmd, pattern, reverse=False, sum_value=None, verbose=True, *args, **kwargs):
+    def cmd_search(self, cmd, pattern, reverse=False, sum_value=None, verbose=True, remote_filter=None,
+                   early_stop=False, *args, **kwargs):
         """Execute a command and check whether a specified regex pattern is in the command output.
 
         - cmd: command to be executed.
@@ -535,22 +1062,40 @@ class InteractiveSubprocess(object):
         - sum_value: if specified, poll till the sum of multiple pattern instances matches the value.
           Note, using both reverse and sum_value is not supported.
         - verbose: if True, show output from all polling iterations. If False, only show output of last poll.
+        - remote_filter: if specified, search the pattern at the remote shell, to only transfer back
+          'lines': the lines matching the pattern, or
+          'count': no output but a line of "<matching lines> <total lines>" counts.
+          The pattern must be an extended regex of awk. Using sum_value with 'count' is not supported.
+        - early_stop: if True, interrupt the command once the pattern is found, see stop of send().
+          It is ignored with sum_value or remote_filter.
         - \*args, \*\*kwargs: optional parameters for self.cmd()
 
         - return: (output, stderr_output, result), outputs of the last execution, and whether found
           expected result.
         """
-        o, e = (self.cmd if verbose else self.cmd_hide)(cmd, *args, **kwargs)
-        m = re.search(pattern, o)
+        run = self.cmd if verbose else self.cmd_hide
+        if remote_filter:
+            assert remote_filter == 'lines' or sum_value is None, \
+                'Using sum_value with remote_filter "%s" is not supported.' % remote_filter
+            o, e, m = self._remote_filter(run, cmd, pattern, remote_filter == 'lines', *args, **kwargs)
+        else:
+            if early_stop and sum_value is None:
+                kwargs.setdefault('stop', pattern)
+            o, e = run(cmd, *args, **kwargs)
+            m = re.search(pattern, o)
         if sum_value is not None:
             assert not reverse, 'Using both sum_value and reverse is not supported.'
-            m = sum_value == util.get_sum(pattern, o)
+            if remote_filter:
+                # awk matches the pattern per line
+                m = sum_value == sum(util.get_sum(pattern, x.rstrip('\r')) for x in o.splitlines())
+            else:
+                m = sum_value == util.get_sum(pattern, o)
         r = bool(m) != bool(reverse)
         return o, e, r
 
     @util.return_o_e_r
     def cmd_poll(self, cmd, pattern, reverse=False, sum_value=None, max_times=10, interval=0.1,
-                 initial_delay=0, verbose=1, *args, **kwargs):
+                 initial_delay=0, verbose=1, remote=False, *args, **kwargs):
         """Execute a command multiple times until a specified pattern is in the command output.
         E.g. waiting for a prcoess completing some time consuming task by polling a command.
 
@@ -563,6 +1108,10 @@ class InteractiveSubprocess(object):
         - interval: time interval between command execution, specified in fraction number of seconds.
         - initial_delay: time to be delayed before starting the polling.
         - verbose: 0: no log, 1: show output of last poll, 2: show output from all polling iterations.
+        - remote: if True, run the polling loop at the remote shell, and only get back the output of the
+          last execution, in one round-trip. The pattern must be an extended regex of "grep -E", and
+          sum_value is not supported. The process must be a shell session, and with verbose 2 only the
+          output of the last execution is shown.
         - \*args, \*\*kwargs: optional parameters for self.cmd()
 
         - return: (output, stderr_output, result), outputs of the last execution, and whether the polling
@@ -570,25 +1119,30 @@ class InteractiveSubprocess(object):
         """
         o = e = ''
         i = 0
-        for i in xrange(max_times + 1):
-            if not self.is_alive():
-                self.print_error('\n%s not alive, cmd_poll "%s" returned, polled %d times' %
-                                 (self.name, cmd, i))
-                return o, e, None
-            time.sleep(initial_delay if i == 0 else interval)
-            o, e, r = self.cmd_search(cmd, pattern=pattern, reverse=reverse, sum_value=sum_value,
-                                      verbose=(verbose == 2), *args, **kwargs)
-            if r:
-                break
-            progress = ('cmd_poll: time spent %.2f seconds, (delay %s, interval %s, %s times), result %s ...' %
-                        (i * interval + initial_delay, initial_delay, interval, i, r))
-            if verbose == 2:
-                self.print_input('%s\n' % progress)
-            elif verbose == 1:
-                util.print_progress(progress, color=['cyan'])
+        if remote:
+            assert sum_value is None, 'Using sum_value with remote polling is not supported.'
+            o, e, r, i = self._remote_poll(cmd, pattern, reverse, max_times, interval, initial_delay,
+                                           verbose == 2, *args, **kwargs)
         else:
-            # did not get the expected polling result
-            r = False
+            for i in xrange(max_times + 1):
+                if not self.is_alive():
+                    self.print_error('\n%s not alive, cmd_poll "%s" returned, polled %d times' %
+                                     (self.name, cmd, i))
+                    return o, e, None
+                time.sleep(initial_delay if i == 0 else interval)
+                o, e, r = self.cmd_search(cmd, pattern=pattern, reverse=reverse, sum_value=sum_value,
+                                          verbose=(verbose == 2), *args, **kwargs)
+                if r:
+                    break
+                progress = ('cmd_poll: time spent %.2f seconds, (delay %s, interval %s, %s times), result %s ...' %
+                            (i * interval + initial_delay, initial_delay, interval, i, r))
+                if verbose == 2:
+                    self.print_input('%s\n' % progress)
+                elif verbose == 1:
+                    util.print_progress(progress, color=['cyan'])
+            else:
+                # did not get the expected polling result
+                r = False
         util.print_progress('')
         if verbose:
             self.print_input('%s cmd_poll "%s": waited %.2f seconds, result %s\n'
@@ -601,8 +1155,37 @@ class InteractiveSubprocess(object):
             self.print_stderr('%s\n' % e)
         return o, e, r
 
+    def _remote_poll(self, cmd, pattern, reverse, max_times, interval, initial_delay, verbose, *args, **kwargs):
+        """Run the polling loop of cmd_poll() at the remote shell, return (o, e, r, polled_times)."""
+        kwargs.setdefault('timeout', initial_delay + (max_times + 1) * (interval + self.timeout))
+        poll_cmd = util.remote_poll_cmd(cmd, pattern, reverse, max_times, interval, initial_delay,
+                                        self.RESULT_MARKER)
+        o, e = (self.cmd if verbose else self.cmd_hide)(poll_cmd, adaptive=False, *args, **kwargs)
+        m = re.search('%s (\d) (\d+)\r?\n' % self.RESULT_MARKER, o)
+        if not m:
+            self.print_error('%s remote cmd_poll "%s" got no result' % (self.name, cmd))
+            return o, e, False, max_times
+        return o[:m.start()] + o[m.end():], e, m.group(1) == '1', int(m.group(2))
+
+    def _remote_filter(self, run, cmd, pattern, lines, *args, **kwargs):
+        """Execute a command with its output filtered by the pattern at the remote shell.
+
+        - run: the method to execute the filtered command, e.g. self.cmd.
+        - lines: if True, transfer back the matching lines, otherwise only the counts.
+        - return: (o, e, n), the outputs, and the number of matching lines. Without lines, the output
+          has a line of "<matching lines> <total lines>" in place of the filtered output.
+        """
+        o, e = run(util.remote_filter_cmd(cmd, pattern, lines, self.RESULT_MARKER), adaptive=False, *args, **kwargs)
+        m = re.search('%s (\d+) (\d+)\r?\n' % self.RESULT_MARKER, o)
+        if not m:
+            self.print_error('%s remote filter of "%s" got no result' % (self.name, cmd))
+            return o, e, 0
+        counts = '' if lines else '%s %s\n' % m.groups()
+        return o[:m.start()] + counts + o[m.end():], e, int(m.group(1))
+
     def cmd_batch(self, cmds, stop_on_error=False, hide_pass=False, precall=None, preargs=(), prekwargs=None,
-                  postcall=None, postargs=(), postkwargs=None, return_pass_fail=False, *args, **kwargs):
+                  postcall=None, postargs=(), postkwargs=None, return_pass_fail=False, remote_filter=None,
+                  early_stop=False, *args, **kwargs):
         """Execute a list of commands, return a list of (cmd, stdout_output, stderr_output, result)
 
         - cmds: a list of command/dict, comment or (command/dict, pass_pattern) to be executed in the sequence order.
@@ -646,6 +1229,10 @@ class InteractiveSubprocess(object):
         - postargs: list of arguments for postcall
         - postkwargs: keyword arguments for postcall
         - return_pass_fail: if True, return False if any command execution does not have expected result.
+        - remote_filter: if specified, check the pass_pattern at the remote shell, see cmd_search().
+            The o of a command with pass_pattern is then the matching lines ('lines'), or the line counts ('count').
+        - early_stop: if True, interrupt a command with pass_pattern once the pass_pattern is found,
+            see stop of send(). The o is then the output till the interrupt.
         - return: a list of (cmd, o, e, r), or True/False if return_pass_fail is True.
         """
         if prekwargs is None:
@@ -670,14 +1257,20 @@ class InteractiveSubprocess(object):
                 results.append((cmd, None, None, None))
                 continue
             # execute the command
-            if isinstance(cmd, dict):
+            stop = dict(stop=pass_pattern) if pass_pattern and early_stop else {}
+            if pass_pattern and remote_filter:
+                cmd_kwargs = dict(cmd) if isinstance(cmd, dict) else dict(kwargs, cmd=cmd)
+                cmd_args = () if isinstance(cmd, dict) else args
+                o, e, found = self._remote_filter(self.cmd, cmd_kwargs.pop('cmd'), pass_pattern,
+                                                  remote_filter == 'lines', *cmd_args, **cmd_kwargs)
+            elif isinstance(cmd, dict):
                 # this is a dict, a command with its specfic arguments
-                o, e = self.cmd(**cmd)
+                o, e = self.cmd(**dict(stop, **cmd))
             else:
                 # this is a command that uses the batch's common arguments
-                o, e = self.cmd(cmd, *args, **kwargs)
+                o, e = self.cmd(cmd, *args, **dict(stop, **kwargs))
             if pass_pattern:
-                if re.search(pass_pattern, o):
+                if (found if remote_filter else re.search(pass_pattern, o)):
                     r = True
                     if not hide_pass:
                         util.print_pass('pattern "%s" found in "%s" output' % (pass_pattern, cmd))
@@ -739,8 +1332,7 @@ class InteractiveSubprocess(object):
     def _send_special(self, key, key_name, expect='', **kwargs):
         """Send special ASCII code to the process."""
         self.print_input('Send %s to %s.\n' % (key_name, self.name))
-        self.stdin.write(key)
-        self.stdin.flush()
+        self._write_input(key)
         return self.flush(expect=expect, end_with_newline=True, **kwargs)
 
     def ctrl_c(self, expect='', **kwargs):
@@ -756,13 +1348,21 @@ class InteractiveSubprocess(object):
         return self._send_special(self.CTRL_SQUARE, 'Ctrl-]', expect=expect, **kwargs)
 
     def clear_buf(self):
+        """Clear the scrollback buffer and the output event log."""
         self.scroll_buf = ''
+        if self.events is not None:
+            self.events = []
 
     def close(self):
-        """Terminate the process."""
-        if not self.is_alive():
-            return
-        self.process.terminate()
+        """Terminate the process, and kill it if it doesn't exit, see close_sessions()."""
+        close_sessions([self])
+
+    def _release(self):
+        """Release the resources of a closed session, i.e. its cassette recorder and the selector of its outputs."""
+        if self._recorder is not None:
+            self._recorder.close()
+        if self._selector is not None:
+            self._selector.close()
 
     def register_method(self, method):
         """To register an add-on method for existing classs instance.
@@ -793,3 +1393,167 @@ class LazyInteractiveSubprocess(InteractiveSubprocess):
         Child class should provice a self._connect() method to evaluate and return the value of process.
         """
         return self._connect()
+
+
+#
+# Concurrent shutdown of many interactive subprocesses.
+#
+def _wait_sessions(sessions, expect, timeout, wait_all):
+    """Wait on the outputs of all sessions in one selector, see wait_any() and wait_all()."""
+    patterns = dict((s, (expect.get(s, '') if isinstance(expect, dict) else expect) or s.prompt) for s in sessions)
+    searched = {}   # (session, stream): length of the output already searched
+
+    def matched(s):
+        if not (s.is_alive() and (s.stdout in s._selector or s.stderr in s._selector)):
+            return True
+        for stream, text in ((s.STDOUT, s._remaining_output + s._peek_out),
+                             (s.STDERR, s._remaining_err_output + s._peek_err)):
+            if s._find_expect(patterns[s], text, searched.get((s, stream), 0)) is not None:
+                return True
+            searched[(s, stream)] = len(text)
+        return False
+
+    selector = util.DefaultSelector()
+    terminals = {}
+    for s in sessions:
+        for x, stream in ((s.stdout, s.STDOUT), (s.stderr, s.STDERR)):
+            if s.is_alive() and x in s._selector:
+                selector.register(x)
+                terminals[x] = (s, stream)
+    deadline = None if timeout is None else time.time() + timeout
+    done, pending, changed = [], list(sessions), set(sessions)
+    try:
+        while pending:
+            done += [s for s in pending if (s in changed and matched(s)) or not s.is_alive()]
+            pending = [s for s in pending if s not in done]
+            if not pending or (done and not wait_all):
+                break
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            changed = set()
+            # wake up to check the liveness, as a process may exit without an EOF of its outputs.
+            for x in selector.select(min(remaining, InteractiveSubprocess.POLL_INTERVAL) if remaining is not None
+                                     else InteractiveSubprocess.POLL_INTERVAL):
+                s, stream = terminals[x]
+                # keep the output for the later consumption, as peek()
+                if stream == s.STDOUT:
+                    s._peek_out += s._read_stream(stream)
+                else:
+                    s._peek_err += s._read_stream(stream)
+                if x not in s._selector:
+                    # EOF
+                    selector.unregister(x)
+                changed.add(s)
+    finally:
+        selector.close()
+    return done, pending
+
+
+def wait_any(sessions, expect='', timeout=None):
+    """Wait till the output of any of the sessions has the expected output, e.g. for the first done of
+    many commands running in parallel. The outputs of all the sessions are waited in one selector.
+
+    The outputs are not consumed, as peek(). They are returned by the next call of the session, e.g.
+    check_outputs() or flush(). The leftover output of a session's previous call is also searched.
+
+    - sessions: a list of InteractiveSubprocess.
+    - expect: a regex string of the expected output for all sessions, or a dict of {session: regex}.
+        If it is '' (default), or a session is not in the dict, wait for the session's prompt.
+    - timeout: max time in seconds to wait. If None, wait till any session has the expected output.
+    - return: (done, pending), the lists of sessions which have the expected output, or have exited,
+        and the other sessions.
+    """
+    return _wait_sessions(sessions, expect, timeout, wait_all=False)
+
+
+def wait_all(sessions, expect='', timeout=None):
+    """Wait till the outputs of all the sessions have the expected output, or timeout.
+    The parameters and return are same as wait_any().
+    """
+    return _wait_sessions(sessions, expect, timeout, wait_all=True)
+
+
+_exit_sessions = set()
+
+
+def close_at_exit(session):
+    """Register a session to be closed at program exit.
+    All registered sessions are closed together by a single close_sessions() exit handler,
+    instead of one by one.
+    """
+    _exit_sessions.add(session)
+    util.exit_handler(close_sessions)
+
+
+def close_sessions(sessions=None, timeout=3, max_exits=5, kill_timeout=0.5):
+    """Gracefully close many sessions concurrently.
+
+    The exit command is sent to all sessions at once, then their outputs are drained in a single
+    select() loop till the processes exit or the overall timeout. A session without exit_cmd is
+    terminated right away. If a session shows its prompt
+    again (user started another shell in it), the exit command is resent. Sessions still alive
+    at the deadline are terminated, and killed if they still don't exit.
+
+    - sessions: a list of InteractiveSubprocess. If None, close all sessions registered by close_at_exit().
+    - timeout: overall time in seconds to wait for all sessions to exit gracefully.
+    - max_exits: max number of exit commands sent to a session.
+    - kill_timeout: time in seconds to wait after terminate, before kill the remaining processes.
+    """
+    if sessions is None:
+        sessions = list(_exit_sessions)
+    for s in sessions:
+        _exit_sessions.discard(s)
+    alive = [s for s in sessions if s.is_alive()]
+    exits = dict((s, 0) for s in alive)
+    outputs = dict((s, '') for s in alive)
+
+    def send_exit(s):
+        if not s.exit_cmd or exits[s] >= max_exits:
+            return
+        exits[s] += 1
+        outputs[s] = ''
+        try:
+            s._write_input(s.exit_cmd + '\n')
+        except (IOError, OSError, ValueError):  # I/O operation on closed file
+            pass
+
+    for s in alive:
+        send_exit(s)
+    # only the sessions sent an exit command are waited, the others are terminated right away.
+    exiting = [s for s in alive if exits[s]]
+    # wait on the outputs of all exiting sessions in one selector
+    selector = util.DefaultSelector()
+    terminals = {}
+    for s in exiting:
+        for x, stream in ((s.stdout, s.STDOUT), (s.stderr, s.STDERR)):
+            if x in s._selector:
+                selector.register(x)
+                terminals[x] = (s, stream)
+    deadline = time.time() + timeout
+    while exiting and time.time() < deadline:
+        for x in selector.select(min(0.05, deadline - time.time())):
+            s, stream = terminals[x]
+            outputs[s] += s._read_stream(stream)
+            if x not in s._selector:
+                # EOF
+                selector.unregister(x)
+            elif s.prompt and re.search(s.prompt, outputs[s]):
+                # back to a prompt of an outer shell, exit again.
+                send_exit(s)
+        exiting = [s for s in exiting if s.is_alive()]
+    selector.close()
+    alive = [s for s in alive if s.is_alive()]
+
+    # The shell may in a state not accepting exit cmd, kill the process directly.
+    for s in alive:
+        s.process.terminate()
+    deadline = time.time() + kill_timeout
+    while alive and time.time() < deadline:
+        time.sleep(0.01)
+        alive = [s for s in alive if s.is_alive()]
+    for s in alive:
+        s.print_warn('Process %s did not exit in %s seconds, killed.' % (s.name, timeout + kill_timeout))
+        s.process.kill()
+    for s in sessions:
+        s._release()
@@ -5,8 +5,7 @@
 
 
 import os
-import re
-import time
+import pwd
 
 import interact
 import util
@@ -18,8 +17,10 @@ import util
 class TelnetSession(interact.LazyInteractiveSubprocess):
     """An interactive subprocess connection of Telnet."""
 
+    exit_cmd = 'exit'
+
     def __init__(self, hostname, username='regress', password='MaRtInI', su_password='Embe1mpls',
-                 ip=None, port=None, prompt=None, timeout=10, **kwargs):
+                 ip=None, port=None, prompt=None, timeout=10, native=False, host_facts=True, **kwargs):
         """Init a InteractiveSubprocess telnet connection to a regular server.
 
         - hostname: the hostname shows in the telnet prompt.
@@ -29,9 +30,19 @@ class TelnetSession(interact.LazyInteractiveSubprocess):
         - port: a port number to be used for telnet, if need a non-default telnet port to connect the RE.
         - prompt: a regex string of the expected prompt.
           Default is a best guess, '(\\x1b\[[;\d]+m)?~(\\x1b\[0?m)?> |\][#|\>|\$] '
+        - native: if True, use the in-process telnet client of telnet.TelnetProcess, instead of spawning
+          a telnet program. It saves a process and its pipes per connection.
+        - host_facts: if True, cache the learned prompt of the server in util.HostFacts, for later connections.
+          Not used when recording or replaying a cassette.
 
         """
         self.name = hostname
+        self.ip = ip
+        self.port = port
+        self.native = native
+        # a cassette has the inputs of its connection, don't let the host facts change them.
+        cassette = kwargs.get('record') or kwargs.get('replay')
+        self.host_facts = util.HostFacts() if host_facts and not cassette else None
         self.prog = 'telnet -l %s %s %s' % (username, ip if ip else hostname, port if port else '')
         self.edit_prompt = '\[edit\]\nregress@%s# ' % hostname
         self.username = username
@@ -45,36 +56,38 @@ class TelnetSession(interact.LazyInteractiveSubprocess):
     def _connect(self):
         """Telnet connect to vre."""
         super(TelnetSession, self)._connect()
-        # Register a exit handler to close the subprocess,
+        # Register to close the subprocess at exit,
         # in case user script exits abnormally.
-        util.exit_handler(self.close)
-
-        # login and su
-        self.cmd_hide(None, expect='Password:')
+        interact.close_at_exit(self)
+        key = 'telnet:%s@%s:%s' % (self.username, self.ip if self.ip else self.name, self.port or 23)
+        facts = self.host_facts.get(key) if self.host_facts else None
+        if facts:
+            self.prompt_literal = facts['prompt']
+
+        # login and su. Server asks for login name if it doesn't take the user from telnet -l.
+        # The login prompt is startup output, so it is not a leftover to be skipped.
+        o, e = self.cmd_hide(None, expect='[Ll]ogin: |Password:', continuous_output=True)
+        if o.endswith('ogin: '):
+            self.cmd_hide(self.username, expect='Password:')
         self.cmd_hide(self.password, hide_input=True)
         if self.su_password:
             self.cmd_hide('su', expect='Password')
             self.cmd_hide(self.su_password, hide_input=True)
         # clear the password for credential reason. It is no longer needed after login.
         del self.password
+        if self.host_facts and self.prompt_literal and facts != {'prompt': self.prompt_literal}:
+            self.host_facts.set(key, prompt=self.prompt_literal)
         return self.process
 
+    def _spawn(self):
+        if not self.native:
+            return super(TelnetSession, self)._spawn()
+        import telnet
+        return telnet.spawn(self, self.ip if self.ip else self.name, self.port, username=self.username)
+
     def close(self):
         # user may started other shell in the ssh connection, exit till the subprocess is closed.
-        for i in xrange(5):
-            if self.is_alive():
-                try:
-                    self.cmd_hide('exit', expect='exit|logout', ignore_no_output=i < 1)
-                except ValueError:  # I/O operation on closed file
-                    pass
-            if self.is_alive():
-                time.sleep(0.1)
-            else:
-                return
-        else:
-            # The shell may in a state not accepting exit cmd.
-            # Call InteractiveSubprocess.close(), which kills the process directly.
-            super(TelnetSession, self).close()
+        interact.close_sessions([self])
 
     def background_proc(self, *args, **kwargs):
         """To return a context manager for "with" statement. It will start and close a background process."""
@@ -91,16 +104,31 @@ class PerhostTelnetSession(TelnetSession):
 #
 class SshSession(interact.LazyInteractiveSubprocess):
     """A subprocess connection to a regular server for interactive command execution."""
-    def __init__(self, host=None, user=None, timeout=10, sshpass=None, **kwargs):
+
+    exit_cmd = 'exit'
+    # marker line to terminate the output of the shell probe at connection time
+    PROBE_MARKER = '__INTERACT_PROBE__'
+
+    def __init__(self, host=None, user=None, timeout=10, sshpass=None, host_facts=True, consistent_prompt=False,
+                 **kwargs):
         """Open a InteractiveSubprocess with default settings.
 
         - host: a network hostname, IP address, or localhost.
             - If host is specified, use a SSH connection.
             - If host is None, use a interactive bash session.
         - user: if None, ssh login as the current user
+        - host_facts: if True, cache the discovered shell type, hostname and prompt of a remote host
+            in util.HostFacts, so later connections to the host skip the discovery. Not used when recording
+            or replaying a cassette.
+        - consistent_prompt: if True and no prompt is given, after the login to a remote host, probe its shell
+            and set the prompt to "user@hostname cwd> ", as for a local session. It costs a round-trip or two
+            per connection. Otherwise the guessed prompt is used.
         """
         self.username = user if user else os.getlogin()
         self.host = host
+        # a cassette has the inputs of its connection, don't let the host facts change them.
+        cassette = kwargs.get('record') or kwargs.get('replay')
+        self.host_facts = util.HostFacts() if host_facts and host is not None and not cassette else None
         self._init_flush = True
         self._init_prompt = False
         if self.host is None:
@@ -108,7 +136,8 @@ class SshSession(interact.LazyInteractiveSubprocess):
             if not hasattr(self, 'use_pty_stdin'):
                 self.use_pty_stdin = True
             if not hasattr(self, 'hostname'):
-                self.hostname = os.popen('hostname -s').read().strip()
+                # same as "hostname -s", without a subprocess
+                self.hostname = os.uname()[1].split('.')[0]
             if not hasattr(self, 'name'):
                 self.name = 'bash@%s' % self.hostname
             if not hasattr(self, 'cmdline'):
@@ -128,7 +157,7 @@ class SshSession(interact.LazyInteractiveSubprocess):
                 self.cmdline = "bash -c csh"
                 self.shelltype = 'csh'
             if not hasattr(self, 'prompt'):
-                self.whoami = os.popen('whoami').read().strip()
+                self.whoami = pwd.getpwuid(os.geteuid()).pw_name   # same as "whoami"
                 self.prompt = ''
                 self._init_prompt = True
                 self._init_flush = False
@@ -143,8 +172,10 @@ class SshSession(interact.LazyInteractiveSubprocess):
             if not hasattr(self, 'name'):
                 self.name = self.host
             if not hasattr(self, 'prompt'):
-                # best guess of user prompt is '~> ', ']# ', or ']:# ', with or without ANSI color codes
+                # best guess of user prompt is '~> ', ']# ', or ']:# ', with or without ANSI color codes,
+                # also to wait for the login if a consistent prompt is set after, see _connect_remote().
                 self.prompt = '(\\x1b\[[;\d]+m)?~(\\x1b\[0?m)?> |\]# |\]\:# '
+                self._init_prompt = consistent_prompt
         super(SshSession, self).__init__(cmd=self.cmdline,
                                          name=self.name, prompt=self.prompt,
                                          timeout=60,       # 60 seconds timeout for manual login
@@ -160,9 +191,9 @@ class SshSession(interact.LazyInteractiveSubprocess):
         else:
             process = self._connect_remote()
         if process:
-            # Register a exit handler to close the subprocess,
+            # Register to close the subprocess at exit,
             # in case user script exits abnormally.
-            util.exit_handler(self.close)
+            interact.close_at_exit(self)
         return process
 
     def _connect_remote(self):
@@ -180,20 +211,44 @@ class SshSession(interact.LazyInteractiveSubprocess):
         if not self.is_alive():
             self.print_warn('Failed to SSH connect to "%s".' % self.host)
 
+        key = '%s@%s' % (self.username, self.host)
+        facts = (self.host_facts.get(key) if self.host_facts else None) or {}
         if self._init_prompt:
             # To simplify the application level scripting, use a consistent prompt string.
-            o, e = self.send('ps -p $$\n', idleout=5)      # As prompt is unknown yet, use idleout to avoid long timeout
-            try:
-                self.shelltype = re.search('\w+sh', o).group()
-            except AttributeError:
-                self.shelltype = 'bash'
-            # Get the hostname from the machine, as user may have provided a IP address.
-            o, e = self.send('hostname -s\n', idleout=5)
-            self.hostname = o.split()[2]
-            self.set_shell_prompt()
+            # The shell of a known host is from the host facts, unless the prompt fails with it.
+            if 'shelltype' in facts:
+                self.hostname, self.shelltype = facts['hostname'], facts['shelltype']
+            if not ('shelltype' in facts and self.set_shell_prompt()):
+                self._probe_shell()
+                self.set_shell_prompt()
             self.print_output('\n')
+        elif facts.get('prompt'):
+            self.prompt_literal = facts['prompt']
+        if self.host_facts and self.is_alive():
+            new_facts = dict(prompt=self.prompt_literal)
+            if self._init_prompt:
+                new_facts.update(hostname=self.hostname, shelltype=self.shelltype)
+            if new_facts != facts:
+                self.host_facts.set(key, **new_facts)
         return self.process
 
+    def _probe_shell(self):
+        """Discover the shell type and hostname of the connected server in one round-trip.
+
+        As the prompt is unknown yet, the probe output is terminated by a marker line, so the
+        probe returns as soon as the marker arrives, instead of waiting for an idleout.
+        """
+        o, e = self.send('ps -p $$; hostname -s; %s\n' % util.echo_marker(self.PROBE_MARKER),
+                         expect='%s\r?\n' % self.PROBE_MARKER)
+        lines = [x.strip() for x in o.splitlines()]
+        try:
+            # Get the hostname from the machine, as user may have provided a IP address.
+            self.hostname = lines[lines.index(self.PROBE_MARKER) - 1]
+        except ValueError:
+            self.hostname = self.host
+        # the shell is the CMD column of "ps -p $$", e.g. "12345 pts/1 00:00:00 -bash"
+        self.shelltype = util.get_field('(?m)^\d+ .*?(\w*sh)$', '\n'.join(lines)) or 'bash'
+
     def _connect_local(self):
         """Connect to an interactive bash session on a local server."""
         super(SshSession, self)._connect()
@@ -202,7 +257,7 @@ class SshSession(interact.LazyInteractiveSubprocess):
         return self.process
 
     def set_shell_prompt(self):
-        """Set the shell prompt to default, "user@hostname cwd> "."""
+        """Set the shell prompt to default, "user@hostname cwd> ". Return True if the new prompt is found."""
         prompt = '%s@%s .+> ' % (self.whoami, self.hostname)
         if 'csh' in self.shelltype:
             # csh or tcsh
@@ -210,23 +265,11 @@ class SshSession(interact.LazyInteractiveSubprocess):
         else:
             # bash etc
             self.cmd_hide('export PS1="\u@\h \w> "', new_prompt=prompt)
+        return self.prompt_literal is not None
 
     def close(self):
         # user may started other shell in the ssh connection, exit till the subprocess is closed.
-        for i in xrange(5):
-            if self.is_alive():
-                try:
-                    self.cmd_hide('exit', expect='exit|logout', ignore_no_output=i < 1)
-                except ValueError:  # I/O operation on closed file
-                    pass
-            if self.is_alive():
-                time.sleep(0.1)
-            else:
-                return
-        else:
-            # The shell may in a state not accepting exit cmd.
-            # Call InteractiveSubprocess.close(), which kills the process directly.
-            super(SshSession, self).close()
+        interact.close_sessions([self])
 
     def background_proc(self, *args, **kwargs):
         """To return a context manager for "with" statement. It will start and close a background process."""
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# Shard the InteractiveSubprocess sessions across worker processes, to scale the read loops with CPU cores.
+# Copyright (c) 2014 Dongsheng Mu.
+# License: MIT (http://www.opensource.org/licenses/mit-license.php)
+
+
+import multiprocessing
+import threading
+import traceback
+
+from multiprocessing.pool import ThreadPool
+
+
+def _serve(conn, threads):
+    """The loop of a worker process, to own its sessions and run the calls of the parent on them.
+
+    A request is ('open', sid, cls, args, kwargs), ('call', [(sid, method, args, kwargs), ...]), or None to
+    close all the sessions and exit. The reply is a list of (ok, value), value is the exception if not ok.
+    """
+    import interact
+    sessions = {}
+    pool = None
+
+    def run(call):
+        sid, method, args, kwargs = call
+        try:
+            return True, getattr(sessions[sid], method)(*args, **kwargs)
+        except Exception as e:
+            e.traceback = traceback.format_exc()
+            return False, e
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            request = None
+        if request is None:
+            break
+        if request[0] == 'open':
+            sid, cls, args, kwargs = request[1:]
+            try:
+                sessions[sid] = cls(*args, **kwargs)
+                conn.send([(True, sessions[sid].name)])
+            except Exception as e:
+                e.traceback = traceback.format_exc()
+                conn.send([(False, e)])
+        else:
+            calls = request[1]
+            if len(calls) > 1:
+                # run the sessions of a batch concurrently, each waits on its own outputs
+                if pool is None:
+                    pool = ThreadPool(threads)
+                conn.send(pool.map(run, calls, chunksize=1))
+            else:
+                conn.send(map(run, calls))
+            for sid, method, args, kwargs in calls:
+                if method == 'close':
+                    sessions.pop(sid, None)
+    # the exit handlers don't run in a multiprocessing child, close the sessions now.
+    interact.close_sessions(sessions.values())
+    conn.close()
+
+
+class SessionProxy(object):
+    """The parent side of a session in a worker process of SessionPool. A method call is run in the
+    worker, and returns the result. The arguments and the result must be picklable.
+    """
+    def __init__(self, pool, worker, sid, name):
+        self._pool = pool
+        self._worker = worker
+        self.sid = sid
+        self.name = name
+
+    def call(self, method, *args, **kwargs):
+        """Call a method of the session in the worker, and return its result."""
+        return self._pool.call_all([self], method, *args, **kwargs)[0]
+
+    def cmd(self, *args, **kwargs):
+        return self.call('cmd', *args, **kwargs)
+
+    def cmd_batch(self, *args, **kwargs):
+        return self.call('cmd_batch', *args, **kwargs)
+
+    def check_outputs(self, *args, **kwargs):
+        return self.call('check_outputs', *args, **kwargs)
+
+    def close(self):
+        return self.call('close')
+
+
+class SessionPool(object):
+    """A pool of worker processes, each owns a shard of the sessions and runs their read loops, so
+    the regex matching and decoding of many chatty sessions scale with the CPU cores. Eg::
+
+        pool = SessionPool(4)
+        hosts = [pool.open(pyssh.SshSession, 'host%d' % i, hide_output=True) for i in range(400)]
+        outputs = pool.call_all(hosts, 'cmd', 'show version')
+        pool.close()
+
+    A session is opened in the worker with the fewest sessions. Calls of the sessions in one worker
+    are run concurrently by up to threads per worker. The outputs printed by the workers are not
+    synchronized, hide_output of the sessions is suggested.
+    """
+    def __init__(self, workers=None, threads=32):
+        """Start the worker processes.
+
+        - workers: number of worker processes, default to the CPU cores.
+        - threads: max concurrent calls in a worker.
+        """
+        self._workers = []
+        for i in xrange(workers or multiprocessing.cpu_count()):
+            conn, child_conn = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=_serve, args=(child_conn, threads), name='session shard %d' % i)
+            p.daemon = True
+            p.start()
+            child_conn.close()
+            # a lock per worker pairs each request with its reply, for callers in many threads.
+            self._workers.append((p, conn, threading.Lock()))
+        self._sizes = [0] * len(self._workers)
+        self._next_sid = 0
+
+    def _request(self, requests):
+        """Send the requests of {worker index: request}, and return {worker index: reply}.
+        Raise the exception of the first failed reply.
+        """
+        order = sorted(requests)
+        for i in order:
+            self._workers[i][2].acquire()
+        try:
+            for i in order:
+                self._workers[i][1].send(requests[i])
+            replies = dict((i, self._workers[i][1].recv()) for i in order)
+        finally:
+            for i in order:
+                self._workers[i][2].release()
+        for i in order:
+            for ok, value in replies[i]:
+                if not ok:
+                    raise value
+        return replies
+
+    def open(self, cls, *args, **kwargs):
+        """Open a session of the class, e.g. pyssh.SshSession, in a worker, and return its SessionProxy.
+        The class and the arguments must be picklable.
+        """
+        worker = self._sizes.index(min(self._sizes))
+        sid = self._next_sid
+        self._next_sid += 1
+        name = self._request({worker: ('open', sid, cls, args, kwargs)})[worker][0][1]
+        self._sizes[worker] += 1
+        return SessionProxy(self, worker, sid, name)
+
+    def call_all(self, proxies, method, *args, **kwargs):
+        """Call a method of all the sessions with the same arguments, in parallel across the workers,
+        and return a list of the results, in the order of the proxies.
+        """
+        batches = {}
+        for x in proxies:
+            batches.setdefault(x._worker, []).append((x.sid, method, args, kwargs))
+        replies = self._request(dict((i, ('call', calls)) for i, calls in batches.items()))
+        results = dict(((i, call[0]), value) for i, calls in batches.items()
+                       for call, (ok, value) in zip(calls, replies[i]))
+        if method == 'close':
+            for i, calls in batches.items():
+                self._sizes[i] -= len(calls)
+        return [results[(x._worker, x.sid)] for x in proxies]
+
+    def close(self, timeout=10):
+        """Close all the sessions, and stop the worker processes."""
+        for p, conn, lock in self._workers:
+            with lock:
+                try:
+                    conn.send(None)
+                except (IOError, EOFError):
+                    pass
+        for p, conn, lock in self._workers:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+            conn.close()
+        self._workers = []
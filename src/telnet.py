@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# Native telnet client, an in-process backend of InteractiveSubprocess instead of the telnet program.
+# Copyright (c) 2014 Dongsheng Mu.
+# License: MIT (http://www.opensource.org/licenses/mit-license.php)
+
+
+import errno
+import os
+import select
+import socket
+from telnetlib import IAC, DONT, DO, WONT, WILL, SB, SE, ECHO, SGA, TTYPE, NAWS, NEW_ENVIRON
+
+
+# NEW-ENVIRON sub-option codes, RFC 1572
+ENV_IS, ENV_SEND, ENV_VAR, ENV_VALUE = '\x00', '\x01', '\x00', '\x01'
+
+
+class TelnetProcess(object):
+    """A telnet connection over a non-blocking socket, with the interface of subprocess.Popen
+    that InteractiveSubprocess uses, i.e. stdin, stdout, stderr file objects, poll(), terminate()
+    and kill(). It does the telnet option negotiation in-process, so a connection costs only
+    a socket, instead of a telnet process and its pipes.
+
+    The connection is ended when the server closes it, or by terminate()/kill().
+    """
+    # options the client accepts to be enabled at the server side
+    REMOTE_OPTIONS = (ECHO, SGA)
+    # options the client agrees to enable at its own side
+    LOCAL_OPTIONS = (SGA, TTYPE, NAWS, NEW_ENVIRON)
+
+    def __init__(self, host, port=None, username=None, term='xterm', window=(200, 50), timeout=10):
+        """Connect to a telnet server.
+
+        - host, port: the telnet server address. Default port is 23.
+        - username: if specified, sent as the USER environment variable, same as "telnet -l username".
+        - term: the terminal type sent to the server.
+        - window: the (width, height) of the terminal window sent to the server.
+        - timeout: timeout in seconds to establish the TCP connection.
+        """
+        self.pid = None
+        self.returncode = None
+        self.username = username
+        self.term = term
+        self.window = window
+        self.sock = socket.create_connection((host, port or 23), timeout)
+        self.sock.setblocking(0)
+        self.fd = self.sock.fileno()   # still valid for unregister from selector after close
+        self.stdin = TelnetWriter(self)
+        self.stdout = TelnetReader(self)
+        # telnet has no separate error stream, use a pipe that never has data.
+        r, self._stderr_w = os.pipe()
+        self.stderr = os.fdopen(r, 'r', 0)
+        self._remote = set()    # options enabled at server side
+        self._local = set()     # options enabled at client side
+        self._partial = ''      # incomplete telnet command at the end of received data
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            select.select([self.sock], [], [])
+            self.stdout.read()
+        return self.returncode
+
+    def _close(self, returncode):
+        if self.returncode is None:
+            self.returncode = returncode
+            self.sock.close()
+            self.stderr.close()
+            os.close(self._stderr_w)
+
+    def terminate(self):
+        self._close(-15)
+
+    def kill(self):
+        self._close(-9)
+
+    def send_raw(self, data):
+        """Send raw data, wait for the socket to be writable if its buffer is full."""
+        while data:
+            try:
+                data = data[self.sock.send(data):]
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                select.select([], [self.sock], [])
+
+    def _negotiate(self, cmd, opt):
+        """Respond to a WILL/WONT/DO/DONT request, only on the change of option state to avoid loop."""
+        if cmd == WILL:
+            if opt in self.REMOTE_OPTIONS:
+                if opt not in self._remote:
+                    self._remote.add(opt)
+                    self.send_raw(IAC + DO + opt)
+            else:
+                self.send_raw(IAC + DONT + opt)
+        elif cmd == WONT:
+            if opt in self._remote:
+                self._remote.discard(opt)
+                self.send_raw(IAC + DONT + opt)
+        elif cmd == DO:
+            if opt in self.LOCAL_OPTIONS and (opt != NEW_ENVIRON or self.username):
+                if opt not in self._local:
+                    self._local.add(opt)
+                    self.send_raw(IAC + WILL + opt)
+                if opt == NAWS:
+                    size = ''.join(chr(x >> 8) + chr(x & 0xff) for x in self.window)
+                    self.send_raw(IAC + SB + NAWS + size.replace(IAC, IAC + IAC) + IAC + SE)
+            else:
+                self.send_raw(IAC + WONT + opt)
+        elif cmd == DONT:
+            if opt in self._local:
+                self._local.discard(opt)
+                self.send_raw(IAC + WONT + opt)
+
+    def _subnegotiate(self, data):
+        """Respond to a sub-negotiation request, data is the content between IAC SB and IAC SE."""
+        opt, sub = data[:1], data[1:2]
+        if opt == TTYPE and sub == ENV_SEND:
+            self.send_raw(IAC + SB + TTYPE + ENV_IS + self.term + IAC + SE)
+        elif opt == NEW_ENVIRON and sub == ENV_SEND and self.username:
+            self.send_raw(IAC + SB + NEW_ENVIRON + ENV_IS + ENV_VAR + 'USER' + ENV_VALUE +
+                          self.username.replace(IAC, IAC + IAC) + IAC + SE)
+
+    def process_received(self, data):
+        """Handle the telnet commands in the received data, and return the remaining text."""
+        data = self._partial + data
+        self._partial = ''
+        text = []
+        i = 0
+        while True:
+            j = data.find(IAC, i)
+            if j < 0:
+                text.append(data[i:])
+                break
+            text.append(data[i:j])
+            cmd = data[j + 1: j + 2]
+            if not cmd:
+                self._partial = data[j:]
+                break
+            if cmd == IAC:
+                text.append(IAC)
+                i = j + 2
+            elif cmd in (WILL, WONT, DO, DONT):
+                if j + 2 >= len(data):
+                    self._partial = data[j:]
+                    break
+                self._negotiate(cmd, data[j + 2])
+                i = j + 3
+            elif cmd == SB:
+                k = data.find(IAC + SE, j + 2)
+                if k < 0:
+                    self._partial = data[j:]
+                    break
+                self._subnegotiate(data[j + 2: k].replace(IAC + IAC, IAC))
+                i = k + 2
+            else:
+                # other commands, e.g. NOP, GA, are ignored.
+                i = j + 2
+        # NVT end of line is CR LF, and a bare CR is sent as CR NUL. A CR at the end is carried to
+        # the next data, which may start with its NUL.
+        text = ''.join(text)
+        if text.endswith('\r') and not self._partial:
+            text, self._partial = text[:-1], '\r'
+        return text.replace('\r\x00', '\r')
+
+
+class TelnetReader(object):
+    """The stdout file object of TelnetProcess."""
+    def __init__(self, process):
+        self.process = process
+
+    @property
+    def closed(self):
+        return self.process.returncode is not None
+
+    def fileno(self):
+        return self.process.fd
+
+    def read(self):
+        """Read all the available text, non-blocking. Return '' at the connection close.
+        Raise IOError EAGAIN if no text is available.
+        """
+        if self.closed:
+            return ''
+        chunks = []
+        while True:
+            try:
+                data = self.process.sock.recv(65536)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                data = ''   # connection reset
+            if not data:
+                # connection closed by server, a carried CR is not followed by its NUL any more.
+                if self.process._partial == '\r':
+                    chunks.append('\r')
+                self.process._close(0)
+                break
+            chunks.append(self.process.process_received(data))
+        text = ''.join(chunks)
+        if not text and not self.closed:
+            # only telnet commands received
+            raise IOError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        return text
+
+
+class TelnetWriter(object):
+    """The stdin file object of TelnetProcess."""
+    def __init__(self, process):
+        self.process = process
+
+    @property
+    def closed(self):
+        return self.process.returncode is not None
+
+    def fileno(self):
+        return self.process.fd
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed telnet connection')
+        # NVT end of line is CR LF, and a bare CR is sent as CR NUL.
+        data = data.replace(IAC, IAC + IAC).replace('\r\n', '\n').replace('\r', '\r\x00').replace('\n', '\r\n')
+        self.process.send_raw(data)
+
+    def flush(self):
+        pass
+
+
+def spawn(session, host, port=None, username=None, **kwargs):
+    """Connect a TelnetProcess for an InteractiveSubprocess, and set its stdin, stdout and stderr.
+    Return None if fail to connect.
+    """
+    try:
+        p = TelnetProcess(host, port, username=username, **kwargs)
+    except socket.error as e:
+        session.print_warn('Fail to telnet connect to %s %s, %s' % (host, port or '', e))
+        return None
+    session.stdin, session.stdout, session.stderr = p.stdin, p.stdout, p.stderr
+    return p
@@ -7,21 +7,20 @@
 from __future__ import print_function  # to use Python3 print function.
 
 import atexit
-import code
+import errno
 import fcntl
 import fnmatch
-import multiprocessing
 import os
 import re
-import readline
 import select
+import signal
 import stat
 import sys
 import termios
 import time
 import tty
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from functools import wraps
 
 
@@ -271,9 +270,90 @@ def get_sum(pattern, o):
     """
     return sum(get_all_num(pattern, o))
 
+
+#
+# Shell command helpers
+#
+def shell_quote(s):
+    """Return a shell-escaped version of the string, as pipes.quote()."""
+    import pipes  # imported on use, it pulls in tempfile and random
+    return pipes.quote(s)
+
+
+def echo_marker(marker):
+    """Return a shell command to echo a marker string, e.g. 'echo __INTER""ACT_PROBE__'.
+    The marker is split by a pair of quotes, so the terminal echo of the command line won't
+    match the marker, only the actual command output will. Works in sh, bash and csh.
+    """
+    half = len(marker) // 2
+    return 'echo %s""%s' % (marker[:half], marker[half:])
+
+
+def remote_poll_cmd(cmd, pattern, reverse=False, max_times=10, interval=0.1, initial_delay=0,
+                    marker='__INTERACT_RESULT__'):
+    """Return a shell command to poll a command at the remote side, till its output has the pattern
+    (or no longer has it, if reverse), for up to max_times + 1 executions. Only the last output is
+    printed, followed by a line of "<marker> <result 1|0> <polled times>".
+
+    - pattern: an extended regex, as in "grep -E".
+    NOTE: the loop is run by "sh -c", so the command works from sh, bash and csh.
+    """
+    script = ('sleep %s; i=0; while :; do o=$( { %s; } 2>&1 ); '
+              'if printf "%%s\\n" "$o" | grep -Eq -- %s; then r=%d; else r=%d; fi; '
+              '[ $r = 1 ] || [ $i -ge %d ] && break; i=$((i+1)); sleep %s; done; '
+              'printf "%%s\\n" "$o"; %s $r $i'
+              % (initial_delay, cmd, shell_quote(pattern), 0 if reverse else 1, 1 if reverse else 0,
+                 max_times, interval, echo_marker(marker)))
+    return 'sh -c %s' % shell_quote(script)
+
+
+def remote_filter_cmd(cmd, pattern, lines=True, marker='__INTERACT_RESULT__'):
+    """Return a shell command to filter the output of a command at the remote side by awk. It prints
+    the lines matching the pattern if lines is True, followed by a line of
+    "<marker> <number of matched lines> <number of all lines>".
+
+    - pattern: an extended regex, as in awk.
+    NOTE: the command is run by "sh -c", so it works from sh, bash and csh.
+    """
+    half = len(marker) // 2
+    script = ('{ %s; } 2>&1 | P=%s awk \'$0 ~ ENVIRON["P"] {n++%s} END {print "%s" "%s", n+0, NR}\''
+              % (cmd, shell_quote(pattern), '; print' if lines else '', marker[:half], marker[half:]))
+    return 'sh -c %s' % shell_quote(script)
+
+
 #
 # Misc
 #
+def bulk_capture_cmd(cmd, begin_marker, end_marker, level=6):
+    """Return a shell command to run a command at the remote side, with its output compressed by
+    gzip and encoded by base64, between a begin and an end marker line.
+    """
+    script = '%s; { %s; } 2>&1 | gzip -c -%d | base64; %s' % (echo_marker(begin_marker), cmd, level,
+                                                              echo_marker(end_marker))
+    return 'sh -c %s' % shell_quote(script)
+
+
+def md5sum_cmd(path):
+    """Return a shell command to print the md5 checksum of a file, by md5sum, or BSD md5."""
+    path = shell_quote(path)
+    return 'sh -c %s' % shell_quote('md5sum -- %s 2>/dev/null || md5 -q -- %s' % (path, path))
+
+
+def upload_block_cmd(path, append=False, compress=True, marker='__INTERACT_RESULT__'):
+    """Return a shell command to receive a block of base64 lines, terminated by Ctrl-D, from the
+    terminal and write it to a file. The terminal echo is disabled while receiving.
+    A line of "<marker> ready" is printed if the file is writable, then "<marker> fail" is printed
+    if the decoding or writing fails.
+
+    - compress: if True, the block is gzip data.
+    """
+    path = shell_quote(path)
+    script = (': %s %s && stty -echo && %s ready && { base64 -d %s>> %s || %s fail; }; stty echo'
+              % ('>>' if append else '>', path, echo_marker(marker), '| gzip -dc ' if compress else '',
+                 path, echo_marker(marker)))
+    return 'sh -c %s' % shell_quote(script)
+
+
 def full_ipv6(ip6):
     """Convert an abbreviated ipv6 address into full address."""
     return ip6.replace('::', '0'.join([':'] * (9 - ip6.count(':'))))
@@ -310,6 +390,149 @@ def tty_nonblocking(fd):
     return old_fl
 
 
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+
+class SelectorBase(object):
+    """A minimal I/O multiplexer with persistent registrations, similar to Python 3 selectors.
+
+    The file objects (or fds) are registered once, then select() waits on all of them, and
+    returns a dict of {fileobj: events} of the ready ones. EINTR returns an empty dict.
+    Subclasses implement the actual system call, epoll, poll or select.
+    """
+    def __init__(self):
+        self._map = {}  # fd: (fileobj, events)
+
+    def __contains__(self, fileobj):
+        return self._fd(fileobj) in self._map
+
+    def __len__(self):
+        return len(self._map)
+
+    @staticmethod
+    def _fd(fileobj):
+        return fileobj if isinstance(fileobj, int) else fileobj.fileno()
+
+    def register(self, fileobj, events=EVENT_READ):
+        fd = self._fd(fileobj)
+        if fd in self._map:
+            return self.modify(fileobj, events)
+        self._map[fd] = (fileobj, events)
+        self._register(fd, events)
+
+    def unregister(self, fileobj):
+        fd = self._fd(fileobj)
+        if self._map.pop(fd, None) is not None:
+            self._unregister(fd)
+
+    def modify(self, fileobj, events):
+        fd = self._fd(fileobj)
+        if self._map[fd][1] != events:
+            self._map[fd] = (fileobj, events)
+            self._modify(fd, events)
+
+    def select(self, timeout=None):
+        """Wait till any registered file is ready, or timeout (in seconds, None to wait forever)."""
+        try:
+            ready = self._select(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            # Interrupted system call, e.g. by a signal handler of the application.
+            return {}
+        return dict((self._map[fd][0], events & self._map[fd][1]) for fd, events in ready if fd in self._map)
+
+    def close(self):
+        self._map = {}
+
+    def _register(self, fd, events):
+        pass
+
+    def _unregister(self, fd):
+        pass
+
+    def _modify(self, fd, events):
+        self._unregister(fd)
+        self._register(fd, events)
+
+
+class SelectSelector(SelectorBase):
+    """Selector with select(), portable but limited to FD_SETSIZE fds."""
+    def _select(self, timeout):
+        r = [fd for fd, (f, events) in self._map.items() if events & EVENT_READ]
+        w = [fd for fd, (f, events) in self._map.items() if events & EVENT_WRITE]
+        r, w, x = select.select(r, w, [], timeout)
+        # an fd both readable and writable is one ready item with both events
+        ready = dict((fd, EVENT_READ) for fd in r)
+        for fd in w:
+            ready[fd] = ready.get(fd, 0) | EVENT_WRITE
+        return ready.items()
+
+
+class PollSelector(SelectorBase):
+    """Selector with poll(), no limit of fd number."""
+    def __init__(self):
+        super(PollSelector, self).__init__()
+        self._poll = select.poll()
+
+    @staticmethod
+    def _mask(events):
+        return ((select.POLLIN | select.POLLPRI if events & EVENT_READ else 0) |
+                (select.POLLOUT if events & EVENT_WRITE else 0))
+
+    def _register(self, fd, events):
+        self._poll.register(fd, self._mask(events))
+
+    def _unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def _modify(self, fd, events):
+        self._poll.modify(fd, self._mask(events))
+
+    def _select(self, timeout):
+        ready = self._poll.poll(None if timeout is None else int(timeout * 1000))
+        # a hang-up or error is reported as ready, so the caller reads and sees the EOF.
+        return [(fd, (EVENT_READ if mask & ~select.POLLOUT else 0) |
+                 (EVENT_WRITE if mask & ~(select.POLLIN | select.POLLPRI) else 0)) for fd, mask in ready]
+
+
+class EpollSelector(PollSelector):
+    """Selector with Linux epoll, O(1) to the number of registered fds."""
+    def __init__(self):
+        SelectorBase.__init__(self)
+        self._poll = select.epoll()
+
+    @staticmethod
+    def _mask(events):
+        return ((select.EPOLLIN | select.EPOLLPRI if events & EVENT_READ else 0) |
+                (select.EPOLLOUT if events & EVENT_WRITE else 0))
+
+    def _unregister(self, fd):
+        try:
+            self._poll.unregister(fd)
+        except (IOError, OSError):  # a closed fd is already removed from epoll
+            pass
+
+    def _select(self, timeout):
+        ready = self._poll.poll(-1 if timeout is None else timeout, max(len(self._map), 1))
+        return [(fd, (EVENT_READ if mask & ~select.EPOLLOUT else 0) |
+                 (EVENT_WRITE if mask & ~(select.EPOLLIN | select.EPOLLPRI) else 0)) for fd, mask in ready]
+
+    def close(self):
+        super(EpollSelector, self).close()
+        self._poll.close()
+
+
+# the most efficient selector of the platform
+if hasattr(select, 'epoll'):
+    DefaultSelector = EpollSelector
+elif hasattr(select, 'poll'):
+    DefaultSelector = PollSelector
+else:
+    DefaultSelector = SelectSelector
+
+
 def pause_for_a_key(msg='Press any key to continue', check_quit=False):
     print_progress(msg + (', or q to quit' if check_quit else '...'))
     c = getch()
@@ -453,6 +676,101 @@ class OutputCapturor(object):
         self.buf = []
 
 
+class OutputGroups(object):
+    """Group the (o, e) outputs of many sessions, e.g. of a same command on many hosts, by identical content.
+    Each distinct output is stored once, and a summary shows each of them once with the names of its group.
+
+    Eg::
+
+        groups = OutputGroups(mask_name=True)
+        for s in sessions:
+            groups.add(s, *s.cmd_hide('uname -r'))
+        groups.print_summary()
+    """
+    def __init__(self, normalize=no_color, mask_name=False):
+        """
+        - normalize: a function to normalize an output text before comparison, e.g. removing the timestamps.
+            Default is to remove the ANSI color codes. None for no normalization.
+        - mask_name: if True, replace the name of a session in its output with '<name>', so the outputs
+            only differ in the hostname, e.g. in the prompt, are grouped together.
+        """
+        self.normalize = normalize
+        self.mask_name = mask_name
+        self.bodies = {}            # digest: (o, e), normalized
+        self.groups = OrderedDict()  # digest: a list of names, in the order added
+        self.digests = {}           # name: digest
+
+    def __len__(self):
+        """Number of distinct outputs."""
+        return len(self.groups)
+
+    def add(self, name, o, e=''):
+        """Add the output of a session, name can be a session object with a name attribute."""
+        import hashlib
+        name = getattr(name, 'name', name)
+        if self.mask_name and name:
+            o, e = o.replace(name, '<name>'), e.replace(name, '<name>')
+        if self.normalize:
+            o, e = self.normalize(o), self.normalize(e)
+        # length of o as the separator, so ('ab', '') and ('a', 'b') differ
+        digest = hashlib.md5('%d:%s%s' % (len(o), o, e)).digest()
+        if digest not in self.bodies:
+            self.bodies[digest] = (o, e)
+            self.groups[digest] = []
+        elif name in self.digests and self.digests[name] == digest:
+            return
+        if name in self.digests:
+            self._remove(name)
+        self.groups[digest].append(name)
+        self.digests[name] = digest
+
+    def _remove(self, name):
+        digest = self.digests.pop(name)
+        self.groups[digest].remove(name)
+        if not self.groups[digest]:
+            del self.groups[digest]
+            del self.bodies[digest]
+
+    def update(self, results):
+        """Add outputs of a dict {name: (o, e)}, or a list of (name, (o, e))."""
+        for name, oe in (results.items() if isinstance(results, dict) else results):
+            self.add(name, *oe)
+
+    def output(self, name):
+        """Return the stored (o, e) of a name."""
+        return self.bodies[self.digests[getattr(name, 'name', name)]]
+
+    def sorted_groups(self):
+        """Return a list of (names, o, e), the largest group first."""
+        return [(names, ) + self.bodies[digest]
+                for digest, names in sorted(self.groups.items(), key=lambda x: -len(x[1]))]
+
+    def _headline(self, names, max_names):
+        more = ' ... (%d more)' % (len(names) - max_names) if len(names) > max_names else ''
+        return '%d of %d: %s%s' % (len(names), len(self.digests), ', '.join(map(str, names[:max_names])), more)
+
+    def summary(self, max_names=10):
+        """Return a text of each distinct output once, under a line of its group size and names.
+
+        - max_names: max number of names listed per group, the rest are counted only.
+        """
+        text = []
+        for names, o, e in self.sorted_groups():
+            text.append('=== ' + self._headline(names, max_names))
+            text += [o.rstrip('\n')] if o else []
+            text += ['stderr:', e.rstrip('\n')] if e else []
+        return '\n'.join(text) + '\n'
+
+    def print_summary(self, max_names=10):
+        """Print the summary, see summary()."""
+        for names, o, e in self.sorted_groups():
+            print_header(self._headline(names, max_names))
+            if o:
+                print_normal(o.rstrip('\n'))
+            if e:
+                print_magenta(e.rstrip('\n'))
+
+
 class Muter():
     """A class to be used by "with" statement, to temporarily hide system output."""
     def __init__(self):
@@ -519,47 +837,117 @@ def sudo(f, *args, **kwargs):
         return f(*args, **kwargs)
 
 
-def find_files(pattern, path=os.curdir, ignore_dirs=None, sort_key=None):
-    """Recursively find all files matching supplied filename pattern in the specified path.
+# scandir() of the Python 2 backport of os.scandir, which saves the stat() of each entry. It is imported
+# on the first use, as it loads ctypes. False if it is not installed.
+scandir = None
+
+
+def _list_dir(path):
+    """Return a list of (name, is_dir, is_symlink) of the entries in a directory.
+    is_dir is True for a symlink to a directory, as os.walk().
+    """
+    global scandir
+    if scandir is None:
+        try:
+            from scandir import scandir
+        except ImportError:
+            scandir = False
+    if not scandir:
+        entries = []
+        prefix = os.path.join(path, '')
+        for name in os.listdir(path):
+            try:
+                fmt = stat.S_IFMT(os.lstat(prefix + name).st_mode)
+            except OSError:
+                continue
+            if fmt == stat.S_IFLNK:
+                entries.append((name, os.path.isdir(prefix + name), True))
+            else:
+                entries.append((name, fmt == stat.S_IFDIR, False))
+        return entries
+    return [(x.name, x.is_dir(), x.is_symlink()) for x in scandir(path)]
+
+
+def _walk(path, ignore_dirs=None):
+    """A top-down os.walk(), yield (pathname, subdirs, files, links) of each directory.
+    subdirs and files are sorted lists of names, links is a set of the subdirs which are symlinks,
+    they are not walked in. The sub directories are walked in sorted order.
+    """
+    ignore_dirs = set(ignore_dirs) if ignore_dirs else set()
+    stack = [os.path.abspath(path)]
+    while stack:
+        pathname = stack.pop()
+        try:
+            entries = _list_dir(pathname)
+        except OSError:     # e.g. permission denied, skip as os.walk()
+            continue
+        subdirs = sorted(x[0] for x in entries if x[1] and x[0] not in ignore_dirs)
+        files = sorted(x[0] for x in entries if not x[1])
+        links = set(x[0] for x in entries if x[1] and x[2])
+        yield pathname, subdirs, files, links
+        stack.extend(os.path.join(pathname, x) for x in reversed(subdirs) if x not in links)
+
+
+def _iter_matches(pattern, path, ignore_dirs, sort_key, threads, dirs):
+    match = re.compile(fnmatch.translate(pattern)).match   # fnmatch.filter() matches the same
+    walker = _walk(path, ignore_dirs)
+    for pathname, subdirs, files, links in walker:
+        for x in sorted((os.path.join(pathname, x) for x in (subdirs if dirs else files) if match(x)),
+                        key=sort_key):
+            yield x
+        if threads:
+            break
+    else:
+        return
+    # scan the sub trees of the top directory in parallel, and yield their matches in order.
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(threads)
+    try:
+        subtrees = [os.path.join(pathname, x) for x in subdirs if x not in links]
+        for matches in pool.imap(lambda x: list(_iter_matches(pattern, x, ignore_dirs, sort_key, 0, dirs)),
+                                 subtrees):
+            for x in matches:
+                yield x
+    finally:
+        pool.terminate()
+
+
+def iter_files(pattern, path=os.curdir, ignore_dirs=None, sort_key=None, threads=0):
+    """A generator of all files matching supplied filename pattern in the specified path, recursively.
+    The files in a directory are yielded in sorted order, before the files of its sub directories.
 
     - pattern: filename matching shell pattern as in 'ls' command, eg. '\*.txt'
     - path: a pathname, can be relative or absolute pathname.
     - ignore_dirs: a list of name of dirs under the specified path, to be skipped.
+    - threads: if not 0, scan the sub directories of path in this many threads, e.g. for a network file system.
     """
-    if ignore_dirs is None:
-        ignore_dirs = []
-    filenames = []
-    for pathname, subdirs, files in os.walk(os.path.abspath(path)):
-        # change the mutable subdirs, so os.walk won't walk in the ignored dir.
-        for x in ignore_dirs:
-            if x in subdirs:
-                subdirs.remove(x)
-        subdirs.sort()
-        filenames += sorted([os.path.join(pathname, filename)
-                             for filename in fnmatch.filter(files, pattern)],
-                            key=sort_key)
-    return filenames
-
-
-def find_dirs(pattern, path=os.curdir, ignore_dirs=None, sort_key=None):
-    """Recursively find all sub directories matching supplied filename pattern in the specified path.
+    return _iter_matches(pattern, path, ignore_dirs, sort_key, threads, dirs=False)
+
+
+def iter_dirs(pattern, path=os.curdir, ignore_dirs=None, sort_key=None, threads=0):
+    """A generator of all sub directories matching supplied filename pattern in the specified path,
+    recursively, in the same order as iter_files().
 
     - pattern: directory name matching shell pattern as in 'ls' command
     - path: a pathname, can be relative or absolute pathname.
     - ignore_dirs: a list of name of dirs under the specified path, to be skipped.
+    - threads: if not 0, scan the sub directories of path in this many threads, e.g. for a network file system.
     """
-    if ignore_dirs is None:
-        ignore_dirs = []
-    dir_names = []
-    for pathname, subdirs, files in os.walk(os.path.abspath(path)):
-        # change the mutable subdirs, so os.walk won't walk in the ignored dir.
-        for x in ignore_dirs:
-            if x in subdirs:
-                subdirs.remove(x)
-        dir_names += sorted([os.path.join(pathname, filename)
-                             for filename in fnmatch.filter(subdirs, pattern)],
-                            key=sort_key)
-    return dir_names
+    return _iter_matches(pattern, path, ignore_dirs, sort_key, threads, dirs=True)
+
+
+def find_files(pattern, path=os.curdir, ignore_dirs=None, sort_key=None, threads=0):
+    """Recursively find all files matching supplied filename pattern in the specified path.
+    Return a list, see iter_files().
+    """
+    return list(iter_files(pattern, path, ignore_dirs, sort_key, threads))
+
+
+def find_dirs(pattern, path=os.curdir, ignore_dirs=None, sort_key=None, threads=0):
+    """Recursively find all sub directories matching supplied filename pattern in the specified path.
+    Return a list, see iter_dirs().
+    """
+    return list(iter_dirs(pattern, path, ignore_dirs, sort_key, threads))
 
 
 def create_sharable_file(filename, data):
@@ -577,6 +965,16 @@ def create_sharable_file(filename, data):
             print_warn(e)
 
 
+def md5_file(filename, chunk_size=1 << 20):
+    """Return the md5 checksum hex string of a file."""
+    import hashlib
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
 def abspath(filepath):
     """Return the absolute pathname for names with '~', '.', '$SRXSRC/obj_sa/bin/flowd'"""
     if '$' in filepath:
@@ -589,6 +987,8 @@ def abspath(filepath):
 
 def setup_interactive_mode(histfile='.python_history', interact=False):
     """Setup interactive mode with tab completion, prompt color, and command history."""
+    # imported on use, as they are only for interactive mode, not worth the startup time of a script.
+    import readline
     # tab completion
     if 'libedit' in readline.__doc__:   # Mac
         print('Please intall GNU readline by "sudo easy_install readline", '
@@ -626,6 +1026,7 @@ def setup_interactive_mode(histfile='.python_history', interact=False):
             IPython.embed()
         except ImportError:
             print("Python interactive mode. Note, use ipython for more interactive support.\n")
+            import code
             code.interact(local=locals())
 
 
@@ -633,6 +1034,7 @@ def h(recent=25):
     """show command history
     recent: number of recent command lines to show.
     """
+    import readline
     length = readline.get_current_history_length()
     start = 0 if length <= recent else (length - recent)
     for x in xrange(start, readline.get_current_history_length()):
@@ -644,11 +1046,17 @@ def find_existing_daemons(daemon_list):
 
     - daemon_list: a list of daemons to be closed, specified by string name. E.g. ['flowd', 'serviced']
     - return: (daemons, pids), a list of process strings as in "ps -eaf", and a list of their pid.
+      On Linux the process strings are "user pid ppid cmd", from ProcessTable.
     """
     if isinstance(daemon_list, str):
         daemon_list = [daemon_list]
+    if ProcessTable.available():
+        # rescan, a daemon may have started since the last call
+        table = ProcessTable()
+        table.scan()
+        return table.find(daemon_list)
 
-    exclude = {'egrep', 'PID', 'sudo', 'vi', 'vim', 'gdb', 'stap', '<defunct>'}
+    exclude = ProcessTable.EXCLUDE
     s = os.popen('sudo ps -eaf | egrep "PID|%s"' % '|'.join(daemon_list)).read()
     pid_col = s.splitlines()[0].split().index('PID')
     daemons = [x for x in s.splitlines() if
@@ -658,28 +1066,38 @@ def find_existing_daemons(daemon_list):
     return daemons, pids
 
 
-def close_existing_daemons(daemon_list, verbose=False):
+def close_existing_daemons(daemon_list, verbose=False, timeout=0.5):
     """Check and close any running specified daemons.
 
     - daemon_list: a list of daemons to be closed, specified by string name. E.g. ['flowd', 'serviced']
+    - timeout: seconds to wait for the daemons to exit after each signal.
     """
     if isinstance(daemon_list, str):
         daemon_list = [daemon_list]
 
     daemons, pids = find_existing_daemons(daemon_list)
     for sig in ['SIGINT', 'SIGKILL']:   # Try SIGINT first. If fail, then do SIGKILL.
-        if daemons:
-            if verbose:
-                print_green('These existing processes will be closed with %s:\n%s' %
-                            (sig, '\n'.join(daemons)))
+        if not daemons:
+            break
+        if verbose:
+            print_green('These existing processes will be closed with %s:\n%s' %
+                        (sig, '\n'.join(daemons)))
+        if ProcessTable.available():
+            # wait on the exit of the processes, instead of re-scanning
+            table = ProcessTable()
+            table.kill(pids, sig)
+            alive = table.wait_exit(pids, timeout)
+            daemons = [x for x, pid in zip(daemons, pids) if pid in alive]
+            pids = alive
+        else:
             os.popen('sudo kill -s %s %s' % (sig, ' '.join(pids)))
-        # confirming the processes are killed
-        for i in xrange(5):
-            daemons, pids = find_existing_daemons(daemon_list)
-            if not daemons:
-                break
-            else:
-                time.sleep(0.1)
+            # confirming the processes are killed
+            for i in xrange(5):
+                daemons, pids = find_existing_daemons(daemon_list)
+                if not daemons:
+                    break
+                else:
+                    time.sleep(timeout / 5)
         if daemons:
             print_red('Failed to close these processes with %s:\n%s' %
                       (sig, '\n'.join(daemons)))
@@ -718,6 +1136,334 @@ class SingletonPerParam(type):
         return cls._instances[key]
 
 
+class ProcessTable(object):
+    """The process table read from /proc directly, instead of running "ps".
+
+    A scan is cached for max_age seconds, with an index of the names in the process command lines,
+    so repeated lookups of daemons don't rescan. find_existing_daemons() rescans per call, for the
+    daemons started since. Linux only, see available().
+    """
+    __metaclass__ = Singleton
+
+    PROC = '/proc'
+    # ps tokens of the processes which are not the daemons, but may have a daemon name in the command line
+    EXCLUDE = {'egrep', 'PID', 'sudo', 'vi', 'vim', 'gdb', 'stap', '<defunct>'}
+    SYS_PIDFD_OPEN = 434   # same on all Linux architectures
+
+    def __init__(self, max_age=0.5):
+        self.max_age = max_age
+        self.time = 0
+        self.procs = {}     # pid: a line of "user pid ppid cmd", as in "ps -eaf"
+        self.index = {}     # name: set of pids, the name is the last path component of a command line token
+        self._users = {}    # uid: user name
+        self._syscall = None
+
+    @classmethod
+    def available(cls):
+        return os.path.isdir(os.path.join(cls.PROC, 'self'))
+
+    def _user(self, uid):
+        if uid not in self._users:
+            import pwd
+            try:
+                self._users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self._users[uid] = str(uid)
+        return self._users[uid]
+
+    def scan(self):
+        """Read all the processes, except zombies."""
+        procs, index = {}, {}
+        for pid in os.listdir(self.PROC):
+            if not pid.isdigit():
+                continue
+            path = os.path.join(self.PROC, pid)
+            try:
+                with open(path + '/stat') as f:
+                    stat = f.read()
+                with open(path + '/cmdline') as f:
+                    cmd = ' '.join(x for x in f.read().split('\0') if x)
+                uid = os.stat(path).st_uid
+            except (IOError, OSError):   # exited
+                continue
+            # "pid (comm) state ppid ...", comm can have spaces and parentheses.
+            state, ppid = stat[stat.rindex(')') + 2:].split(None, 2)[:2]
+            if state == 'Z':
+                continue
+            if not cmd:
+                # kernel thread
+                cmd = '[%s]' % stat[stat.index('(') + 1: stat.rindex(')')]
+            procs[pid] = '%s %s %s %s' % (self._user(uid), pid, ppid, cmd)
+            for token in cmd.split():
+                index.setdefault(token.rsplit('/', 1)[-1], set()).add(pid)
+        self.procs, self.index, self.time = procs, index, time.time()
+
+    def find(self, names):
+        """Find the processes of the names, which are regex of a command line token, or its last path component.
+        Return (processes, pids), a list of process lines of "user pid ppid cmd", and a list of their pids.
+        """
+        if time.time() - self.time > self.max_age:
+            self.scan()
+        if all(re.match('[\\w-]+$', x) for x in names):
+            # plain names, only check the indexed processes
+            candidates = set().union(*[self.index.get(x, ()) for x in names])
+        else:
+            candidates = self.procs
+        pattern = re.compile('|'.join(['(^|[/ ])%s( |$)' % x for x in names]))
+        me = str(os.getpid())
+        pids = sorted((x for x in candidates if x != me and x in self.procs and
+                       pattern.search(self.procs[x].split(' ', 3)[3]) and
+                       not self.EXCLUDE.intersection(self.procs[x].split())), key=int)
+        return [self.procs[x] for x in pids], pids
+
+    def kill(self, pids, sig):
+        """Send a signal, e.g. 'SIGINT', to the processes, with sudo if not permitted."""
+        denied = []
+        for pid in pids:
+            try:
+                os.kill(int(pid), getattr(signal, sig))
+            except OSError as e:
+                if e.errno == errno.EPERM:
+                    denied.append(pid)
+        if denied:
+            os.popen('sudo kill -s %s %s' % (sig, ' '.join(denied))).read()
+
+    def _pidfd_open(self, pid):
+        """Return a pidfd of the process, readable when it exits, or None if not supported."""
+        if self._syscall is None:
+            try:
+                import ctypes
+                self._syscall = ctypes.CDLL(None, use_errno=True).syscall
+            except (ImportError, OSError, AttributeError):
+                self._syscall = False
+        if not self._syscall:
+            return None
+        fd = self._syscall(self.SYS_PIDFD_OPEN, int(pid), 0)
+        return fd if fd >= 0 else None
+
+    def _alive(self, pid):
+        try:
+            with open(os.path.join(self.PROC, pid, 'stat')) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            return False
+        return stat[stat.rindex(')') + 2] != 'Z'
+
+    def wait_exit(self, pids, timeout):
+        """Wait till the processes exit, by their pidfd if supported, otherwise by checking /proc
+        with a backoff interval. Return the pids not exited in timeout seconds.
+        """
+        deadline = time.time() + timeout
+        selector = PollSelector()
+        pidfds = {}     # fd: pid
+        polled = []
+        for pid in pids:
+            fd = self._pidfd_open(pid)
+            if fd is None:
+                polled.append(pid)
+            else:
+                pidfds[fd] = pid
+                selector.register(fd)
+        interval = 0.001
+        try:
+            while True:
+                polled = [x for x in polled if self._alive(x)]
+                if not (pidfds or polled):
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                for fd in selector.select(min(remaining, interval) if polled else remaining):
+                    selector.unregister(fd)
+                    os.close(fd)
+                    del pidfds[fd]
+                interval = min(interval * 2, 0.05)
+        finally:
+            for fd in pidfds:
+                os.close(fd)
+        alive = sorted(pidfds.values() + polled, key=int)
+        for pid in set(pids) - set(alive):
+            self.procs.pop(pid, None)
+        return alive
+
+
+class HostFacts(object):
+    """A persistent cache of the facts discovered from hosts, e.g. shell type and hostname, in a JSON
+    file, so a later connection to a known host can skip the discovery. The facts of a host expire
+    ttl seconds after they are set.
+
+    The file is from the environment variable INTERACT_HOST_FACTS, or ~/.interact/host_facts.json.
+    The cache is disabled if the variable is set to empty.
+    """
+    __metaclass__ = SingletonPerParam
+
+    def __init__(self, path=None, ttl=24 * 3600):
+        if path is None:
+            path = os.environ.get('INTERACT_HOST_FACTS', os.path.join('~', '.interact', 'host_facts.json'))
+        self.path = os.path.expanduser(path) if path else None
+        self.ttl = ttl
+        self._facts = None  # host: {'time': set time, 'facts': {name: value}}
+
+    def _load(self):
+        import json
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, host):
+        """Return a dict of the facts of a host, or None if unknown or expired."""
+        if not self.path:
+            return None
+        if self._facts is None:
+            self._facts = self._load()
+        entry = self._facts.get(host)
+        if not entry or entry['time'] + self.ttl < time.time():
+            return None
+        # json loads unicode strings, convert them back to str as the process outputs.
+        return dict((str(k), v.encode('utf-8') if isinstance(v, unicode) else v)
+                    for k, v in entry['facts'].items())
+
+    def set(self, host, **facts):
+        """Update the facts of a host, and save to the file. Set no facts to forget the host."""
+        if not self.path:
+            return
+        import json
+        # merge with the updates by other processes
+        self._facts = self._load()
+        if facts:
+            self._facts[host] = {'time': time.time(), 'facts': facts}
+        else:
+            self._facts.pop(host, None)
+        tmp = '%s.%d' % (self.path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(tmp, 'w') as f:
+                json.dump(self._facts, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.path)  # atomic replace, a reader never sees a partial file
+        except (IOError, OSError) as e:
+            print_warn('Fail to save host facts to %s, %s' % (self.path, e))
+
+
+class LRUCache(object):
+    """A cache of at most maxsize entries, evicting the least recently used one.
+    An entry expires ttl seconds after it is set, if ttl is not None.
+    """
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._data = OrderedDict()  # key: (expire_time, value), from least to most recently used
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            expire, value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if expire is not None and expire < time.time():
+            self.misses += 1
+            return default
+        self._data[key] = (expire, value)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = (time.time() + self.ttl if self.ttl is not None else None, value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+class RunningStats(object):
+    """Running mean and standard deviation of samples, by Welford's algorithm, without keeping the samples."""
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (x - self.mean)
+
+    @property
+    def stdev(self):
+        return (self._m2 / (self.n - 1)) ** 0.5 if self.n > 1 else 0.0
+
+
+class CommandTiming(object):
+    """Latency statistics per command shape, to suggest a timeout and idleout of a command from
+    the previous executions of the similar commands, i.e. same command shape, see shape().
+
+    The suggestion is factor * (mean + sigmas * stdev), not less than the floor, after at least
+    min_samples executions. The statistics of at most maxsize command shapes are kept.
+    """
+    def __init__(self, min_samples=5, sigmas=4, factor=1.5, min_timeout=0.2, min_idleout=0.1, maxsize=256):
+        self.min_samples = min_samples
+        self.sigmas = sigmas
+        self.factor = factor
+        self.min_timeout = min_timeout
+        self.min_idleout = min_idleout
+        # command shape: (RunningStats of latency, RunningStats of max idle gap)
+        self._stats = LRUCache(maxsize)
+
+    @staticmethod
+    def shape(cmd):
+        """The shape of a command, its first 2 words with the numbers masked,
+        e.g. "ping -c 3 10.1.1.1" and "ping -c 5 10.1.1.2" are both "ping -c".
+        """
+        return re.sub(r'\d+(\.\d+)*', '#', ' '.join(cmd.split()[:2])) if cmd else None
+
+    def _get(self, shape):
+        stats = self._stats.get(shape)
+        if stats is None:
+            stats = (RunningStats(), RunningStats())
+            self._stats.set(shape, stats)
+        return stats
+
+    def record(self, shape, latency=None, idle_gap=None):
+        """Record the latency of a command till its expected output, and the max idle gap within its output."""
+        if shape is None:
+            return
+        stats = self._get(shape)
+        if latency is not None:
+            stats[0].add(latency)
+        if idle_gap is not None:
+            stats[1].add(idle_gap)
+
+    def _suggest(self, shape, index, floor):
+        stats = self._stats.get(shape) if shape is not None else None
+        if stats is None or stats[index].n < self.min_samples:
+            return None
+        x = stats[index]
+        return max(floor, self.factor * (x.mean + self.sigmas * x.stdev))
+
+    def timeout(self, shape):
+        """The suggested timeout of a command shape, None if not enough samples."""
+        return self._suggest(shape, 0, self.min_timeout)
+
+    def idleout(self, shape):
+        """The suggested idleout of a command shape, None if not enough samples."""
+        return self._suggest(shape, 1, self.min_idleout)
+
+    def stats(self, shape):
+        """Return ((n, mean, stdev) of latency, (n, mean, stdev) of max idle gap) of a command shape,
+        None if the shape has no record.
+        """
+        stats = self._stats.get(shape)
+        return tuple((x.n, x.mean, x.stdev) for x in stats) if stats is not None else None
+
+
 class LazyProperty(object):
     """A decorator to defer expensive evaluation of an object attribute, i.e. lazy evaluation.
     The decorated property should represent non-mutable data, as it replaces itself.
@@ -830,6 +1576,7 @@ class RunParallel(object):
 
         self.func = func
         self.name = '%s(*%s, **%s)' % (self.func.__name__, args, kwargs)
+        import multiprocessing  # imported on use, it is heavy
         parent_conn, child_conn = multiprocessing.Pipe()
         self.pipe = parent_conn
         self.process = multiprocessing.Process(target=task, args=(child_conn, func, args, kwargs))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# Tests of the native telnet client against a local stand-in telnet server.
+# Copyright (c) 2014 Dongsheng Mu.
+# License: MIT (http://www.opensource.org/licenses/mit-license.php)
+
+
+import os
+import SocketServer
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import pyssh
+import telnet
+from telnetlib import IAC, DO, WILL, SB, SE, ECHO, TTYPE, NAWS, NEW_ENVIRON
+
+
+PROMPT = '[u@h ~]$ '
+
+
+class StandInHandler(SocketServer.StreamRequestHandler):
+    """A telnet server with the option negotiation, a password login, and a shell of a few commands.
+
+    - echo <text>: output the text.
+    - crnul: output a bare CR as CR NUL, split across two sends.
+    - exit: close the connection.
+    """
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.server.handlers.append(self)
+        self.replies = []   # (cmd, option) of the client negotiation replies
+        self.subs = []      # contents of the client sub-negotiations
+        self.password = None
+
+    def read_line(self):
+        """Read a line of the client, handle its telnet commands. Return None at the connection close."""
+        line = ''
+        while True:
+            c = self.rfile.read(1)
+            if not c:
+                return None
+            if c == IAC:
+                cmd = self.rfile.read(1)
+                if cmd == SB:
+                    sub = ''
+                    while not sub.endswith(IAC + SE):
+                        sub += self.rfile.read(1)
+                    self.subs.append(sub[:-2].replace(IAC + IAC, IAC))
+                elif cmd == IAC:
+                    line += IAC
+                else:
+                    self.replies.append((cmd, self.rfile.read(1)))
+            elif c == '\r':
+                if self.rfile.read(1) in ('\n', '\x00'):
+                    return line
+            elif c == '\n':
+                return line
+            else:
+                line += c
+
+    def handle(self):
+        send = self.wfile.write
+        send(IAC + WILL + ECHO + IAC + DO + TTYPE + IAC + DO + NAWS + IAC + DO + NEW_ENVIRON)
+        send(IAC + SB + TTYPE + telnet.ENV_SEND + IAC + SE)
+        send(IAC + SB + NEW_ENVIRON + telnet.ENV_SEND + IAC + SE)
+        send('Password:')
+        self.password = self.read_line()
+        send('\r\nLast login: today\r\n')
+        while True:
+            send(PROMPT)
+            line = self.read_line()
+            if line is None or line == 'exit':
+                break
+            send(line + '\r\n')
+            if line.startswith('echo '):
+                send(line[5:] + '\r\n')
+            elif line == 'crnul':
+                send('a\r')
+                time.sleep(0.2)
+                send('\x00b\r\n')
+
+
+class TestTelnet(unittest.TestCase):
+    def setUp(self):
+        SocketServer.ThreadingTCPServer.allow_reuse_address = True
+        self.server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.handlers = []
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def session(self):
+        return pyssh.TelnetSession('h', username='u', password='p', su_password=None, ip='127.0.0.1',
+                                   port=self.port, native=True, host_facts=False, hide_output=True,
+                                   print_input=None, timeout=5)
+
+    def test_negotiation_and_login(self):
+        s = self.session()
+        try:
+            o, e = s.cmd('echo hello', hide_output=True)
+            self.assertIn('\nhello\r\n', o)
+            self.assertTrue(o.endswith(PROMPT))
+            handler = self.server.handlers[0]
+            self.assertEqual(handler.password, 'p')
+            self.assertEqual(set(handler.replies), set([(DO, ECHO), (WILL, TTYPE), (WILL, NAWS), (WILL, NEW_ENVIRON)]))
+            self.assertIn(TTYPE + telnet.ENV_IS + 'xterm', handler.subs)
+            self.assertIn(NAWS + '\x00\xc8\x00\x32', handler.subs)
+            self.assertIn(NEW_ENVIRON + telnet.ENV_IS + telnet.ENV_VAR + 'USER' + telnet.ENV_VALUE + 'u', handler.subs)
+        finally:
+            s.close()
+        self.assertFalse(s.is_alive())
+
+    def test_cr_nul_across_sends(self):
+        s = self.session()
+        try:
+            o, e = s.cmd('crnul', hide_output=True)
+            self.assertIn('\na\rb\r\n', o)
+            self.assertNotIn('\x00', o)
+        finally:
+            s.close()
+
+    def test_cr_nul_per_byte(self):
+        p = telnet.TelnetProcess('127.0.0.1', self.port)
+        try:
+            data = 'a\r\x00b\r\nc' + IAC + IAC + '\r'
+            text = ''.join(p.process_received(x) for x in data)
+            self.assertEqual(text, 'a\rb\r\nc' + IAC)
+            self.assertEqual(p.process_received('\x00'), '\r')
+        finally:
+            p.kill()
+
+
+if __name__ == '__main__':
+    unittest.main()